@@ -0,0 +1,117 @@
+import re
+import base64
+import secrets
+import binascii
+from typing import Tuple, Union
+
+from cachetools import LRUCache
+
+import config
+import hls_gateway
+
+ALLOW = 0
+NEED_LOGIN = 1
+NEED_ADMIN = 2
+
+admin_path = [
+    '/api/video/delete', '/api/video/convert', '/api/video/upload', '/api/video/clip', '/api/bili', '/api/manager/delete',
+    '/api/manager/add', '/api/manager/update', '/api/manager/start', '/api/manager/end'
+]
+
+# segment URLs carry their own HMAC token, see hls_gateway
+exempt_path = [hls_gateway.TOKEN_PATH] + list(config.auth_exempt_path)
+
+_admin_regex = re.compile("|".join(re.escape(it) for it in admin_path))
+_exempt_regex = re.compile("|".join(re.escape(it) for it in exempt_path))
+_verified: LRUCache = LRUCache(maxsize=config.auth_cache_size)
+
+
+def get_mode() -> str:
+    """``basic_security`` as one of "off", "on" and "admin", booleans mean "on" and "off" """
+    mode = config.basic_security
+    if mode is True:
+        return "on"
+    if not mode:
+        return "off"
+    return str(mode).lower()
+
+
+def check_permission(info: str) -> Tuple[bool, bool]:
+    """``(is_user, is_admin)`` for a Basic Authorization header"""
+    try:
+        username, password = base64.b64decode(info.replace("Basic ", ""), validate=True).split(b":", 1)
+    except (binascii.Error, ValueError):
+        return False, False
+    is_admin_correct_username = secrets.compare_digest(username, config.admin_username)
+    is_admin_correct_password = secrets.compare_digest(password, config.admin_password)
+    is_correct_username = secrets.compare_digest(username, config.username)
+    is_correct_password = secrets.compare_digest(password, config.password)
+    is_user = is_correct_username and is_correct_password
+    is_admin = is_admin_correct_username and is_admin_correct_password
+    return is_user or is_admin, is_admin
+
+
+def get_permission(info: str) -> Tuple[bool, bool]:
+    """``check_permission`` with accepted headers remembered.
+
+    Browsers resend the same header with every segment and asset, so after the first request a login costs
+    one cache lookup. The header is the key itself: hashing it took longer than the comparisons it saved.
+    Rejected headers are never cached and keep going through the constant time comparisons, the least
+    recently used login is dropped once ``auth_cache_size`` are kept.
+    """
+    res = _verified.get(info)
+    if res is None:
+        res = check_permission(info)
+        if res[0]:
+            _verified[info] = res
+    return res
+
+
+def need_admin(path: str) -> bool:
+    return _admin_regex.match(path) is not None
+
+
+def check(path: str, authorization: Union[str, None]) -> int:
+    """ALLOW, or NEED_LOGIN / NEED_ADMIN when the request has to be answered with 401"""
+    mode = get_mode()
+    if mode == "off" or _exempt_regex.match(path):
+        return ALLOW
+    admin = need_admin(path)
+    if mode == "admin" and not admin:
+        return ALLOW
+    if authorization is None:
+        return NEED_LOGIN
+    is_user, is_admin = get_permission(authorization)
+    if mode == "on" and not is_user:
+        return NEED_LOGIN
+    if admin and not is_admin:
+        return NEED_ADMIN
+    return ALLOW
+
+
+if __name__ == "__main__":
+    import timeit
+
+    def legacy(path: str, authorization: str) -> int:
+        current_username_bytes, current_password_bytes = base64.b64decode(
+            authorization.replace("Basic ", "")).decode().split(':', 1)
+        is_admin_correct_username = secrets.compare_digest(current_username_bytes.encode(), config.admin_username)
+        is_admin_correct_password = secrets.compare_digest(current_password_bytes.encode(), config.admin_password)
+        is_correct_username = secrets.compare_digest(current_username_bytes.encode(), config.username)
+        is_correct_password = secrets.compare_digest(current_password_bytes.encode(), config.password)
+        is_admin = is_admin_correct_username and is_admin_correct_password
+        if not (is_correct_username and is_correct_password or is_admin):
+            return NEED_LOGIN
+        for it in admin_path:
+            if path.startswith(it):
+                return ALLOW if is_admin else NEED_ADMIN
+        return ALLOW
+
+    config.basic_security = "on"
+    header = "Basic " + base64.b64encode(config.username + b":" + config.password).decode()
+    paths = ["/api/video/file", "/static/assets/index.js",
+             "/api/manager", "/api/manager/update"]
+    number = 100000
+    for name, fn in (("legacy", legacy), ("auth.check", check)):
+        elapsed = timeit.timeit(lambda: [fn(it, header) for it in paths], number=number)
+        print(f"{name:<12} {elapsed / number / len(paths) * 1e6:6.2f} us per request")
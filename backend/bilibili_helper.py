@@ -1,6 +1,8 @@
-from typing import Union, List
+from typing import Awaitable, Callable, Dict, Union, List
 import base64
 
+from asyncache import cached
+from cachetools import TTLCache
 from bilibili_api import Credential
 from bilibili_api import video_uploader
 from bilibili_api.user import get_self_info
@@ -8,11 +10,15 @@ from bilibili_api.login_func import get_qrcode, check_qrcode_events, QrCodeLogin
 from pydantic import BaseModel
 
 import config
+import upload
+from upload import UploadJob
 from logger import getLogger
-import asyncio
 
 logger = getLogger(f"Uploader", "INFO")
 
+_credential: Union[Credential, None] = None
+self_info_cache = TTLCache(1, config.bili_info_ttl)
+
 
 class CookieInfo(BaseModel):
     SESSDATA: Union[str, None] = None
@@ -41,41 +47,101 @@ async def login():
     return qr64, key
 
 
+def get_credential() -> Credential:
+    """Credential built from cookie.json, kept in memory until the next login"""
+    global _credential
+    if _credential is None:
+        _credential = load_cookie().to_credential()
+    return _credential
+
+
+def invalidate_credential():
+    global _credential
+    _credential = None
+    self_info_cache.clear()
+
+
 def check(key: str):
     status, cred = check_qrcode_events(key)
     if status == QrCodeLoginEvents.DONE:
         cookie = CookieInfo(**cred.get_cookies())
         cookie.save_cookie()
+        invalidate_credential()
     return status
 
 
+@cached(self_info_cache)
+async def get_cached_self_info() -> dict:
+    return await get_self_info(get_credential())
+
+
 async def get_username():
     try:
-        cookie = load_cookie()
-    except:
+        get_credential()
+    except (OSError, ValueError):
         return '请先登录'
-    cred = cookie.to_credential()
-    info = await get_self_info(cred)
+    info = await get_cached_self_info()
     return info['name']
 
 
-def upload_video(title: str, videos: List[str]):
-    cookie = load_cookie()
-    cred = cookie.to_credential()
-    vu_meta = video_uploader.VideoMeta(
-        tid=233,
-        title=title,
-        desc=title,
-        cover='cover.png',
-        tags=['RoboMaster'],
-    )
-    pages = [
-        video_uploader.VideoUploaderPage(path=str(config.mp4_dir / f'{video}.mp4'), title=video) for video in videos
-    ]
-    uploader = video_uploader.VideoUploader(pages, vu_meta, cred)
-
-    @uploader.on("__ALL__")
-    async def ev(data):
-        logger.info(f"Event: {data}")
-
-    asyncio.create_task(uploader.start())
+class _PageUploader(video_uploader.VideoUploader):
+    """VideoUploader that reports every chunk and waits for the shared bandwidth budget before sending it"""
+
+    def __init__(self, pages: List[video_uploader.VideoUploaderPage], meta: video_uploader.VideoMeta,
+                 credential: Credential, line: dict, throttle: Callable[[int], Awaitable],
+                 progress: Callable[[int], None]):
+        super().__init__(pages, meta, credential, line=line)
+        self.throttle = throttle
+        self.progress = progress
+
+    async def _upload_chunk(self, page, offset, chunk_number, total_chunk_count, preupload):
+        size = min(preupload["chunk_size"], page.get_size() - offset)
+        await self.throttle(size)
+        result = await super()._upload_chunk(page, offset, chunk_number, total_chunk_count, preupload)
+        if result["ok"]:
+            self.progress(size)
+        return result
+
+
+class BilibiliUploader:
+    """Uploader for upload.UploadManager.
+
+    Pages are uploaded one VideoUploader at a time and the video is submitted separately, so the pages
+    that already finished can be reused when a job is resumed.
+    """
+
+    def __init__(self):
+        self.credential = get_credential()
+        self.line: Union[dict, None] = None
+
+    @staticmethod
+    def _meta(title: str) -> video_uploader.VideoMeta:
+        return video_uploader.VideoMeta(tid=233, title=title, desc=title, cover='cover.png', tags=['RoboMaster'])
+
+    async def _get_line(self) -> dict:
+        if self.line is None:
+            self.line = await video_uploader._choose_line(None)
+        return self.line
+
+    async def upload_page(self, path: str, title: str, throttle: Callable[[int], Awaitable],
+                          progress: Callable[[int], None]) -> Dict:
+        page = video_uploader.VideoUploaderPage(path=path, title=title)
+        uploader = _PageUploader([page], self._meta(title), self.credential, await self._get_line(), throttle,
+                                 progress)
+        return await uploader._upload_page(page)
+
+    async def submit(self, title: str, pages: List[Dict]) -> Dict:
+        uploader = video_uploader.VideoUploader([], self._meta(title), self.credential,
+                                                line=await self._get_line())
+
+        @uploader.on("__ALL__")
+        async def ev(data):
+            logger.info(f"Event: {data}")
+
+        cover_url = await uploader._upload_cover()
+        videos = [{"title": it["title"], "desc": "", "filename": it["filename"], "cid": it["cid"]} for it in pages]
+        return await uploader._submit(videos, cover_url)
+
+
+async def upload_video(title: str, videos: List[str]) -> UploadJob:
+    return await upload.jobs.submit(title, [(str(config.mp4_dir / f'{video}.mp4'), video) for video in videos])
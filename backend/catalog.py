@@ -0,0 +1,290 @@
+import os
+import json
+import base64
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+
+import config
+from logger import getLogger
+
+logger = getLogger("Catalog", "INFO")
+
+FIELDS = ["file_name", "title", "red", "blue", "role", "round", "cid", "timestamp",
+          "duration", "segments", "bytes", "mtime", "size"]
+
+SORT_KEYS = {"title", "red", "blue", "role", "round", "cid", "timestamp", "duration", "segments", "bytes",
+             "file_name"}
+INDEXES = ["red", "blue", "role", "round", "cid", "timestamp"]
+
+_lock = threading.Lock()
+_db: Union[sqlite3.Connection, None] = None
+_tables: List[Callable[[sqlite3.Connection], None]] = []
+
+
+def register_table(create: Callable[[sqlite3.Connection], None]):
+    """Have ``create`` set up another module's tables on the shared connection.
+
+    Every module storing state in ``catalog_db`` goes through ``transaction``, so their writes are
+    serialized with each other.
+    """
+    _tables.append(create)
+    if _db is not None:
+        with _lock:
+            create(_db)
+            _db.commit()
+
+
+def _get_db() -> sqlite3.Connection:
+    """The shared connection, opened on first use; callers hold ``_lock``"""
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(config.catalog_db, check_same_thread=False)
+        _db.row_factory = sqlite3.Row
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("""
+            CREATE TABLE IF NOT EXISTS recordings (
+                file_name TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                red TEXT NOT NULL,
+                blue TEXT NOT NULL,
+                role TEXT NOT NULL,
+                round INTEGER NOT NULL,
+                cid INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                duration REAL NOT NULL DEFAULT 0,
+                segments INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                mtime REAL NOT NULL DEFAULT 0,
+                size INTEGER NOT NULL DEFAULT 0,
+                export_file TEXT NOT NULL DEFAULT '',
+                export_bytes INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        columns = [it["name"] for it in _db.execute("PRAGMA table_info(recordings)")]
+        for column, definition in (("export_file", "TEXT NOT NULL DEFAULT ''"),
+                                   ("export_bytes", "INTEGER NOT NULL DEFAULT 0")):
+            if column not in columns:
+                _db.execute(f"ALTER TABLE recordings ADD COLUMN {column} {definition}")
+        for it in INDEXES:
+            _db.execute(f"CREATE INDEX IF NOT EXISTS recordings_{it} ON recordings ({it}, timestamp)")
+        for create in _tables:
+            create(_db)
+        _db.commit()
+    return _db
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """Hold the shared connection for a block, committed when it exits and rolled back on an exception"""
+    with _lock:
+        db = _get_db()
+        with db:
+            yield db
+
+
+def parse_file_name(file_name: str) -> Dict[str, int]:
+    _, cid, _, timestamp = file_name.split(".")[0].split("_")
+    return {"cid": int(cid), "timestamp": int(timestamp)}
+
+
+def parse_title(title: str) -> Union[Dict[str, Union[str, int]], None]:
+    items = title.split(" ")
+    if len(items) != 6:
+        return None
+    return {"title": title, "red": items[0], "blue": items[2], "role": items[3], "round": int(items[4][1:])}
+
+
+def read_playlist(path: Path) -> Dict[str, Union[str, float, List[str]]]:
+    title = "Null Vs Null"
+    duration = 0.
+    files = []
+    with path.open('r', encoding="utf-8") as f:
+        lines = f.readlines()
+    for i in range(len(lines)):
+        line = lines[i]
+        if line.startswith("#TITLE:"):
+            title = line.replace("#TITLE:", "").strip()
+        if line.startswith("#EXTINF:") and i + 1 < len(lines):
+            duration += float(line.split(":")[1].split(",")[0])
+            files.append(lines[i + 1].strip())
+    return {"title": title, "duration": duration, "files": files}
+
+
+def _upsert(row: Dict):
+    _get_db().execute(
+        f"INSERT INTO recordings ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))}) "
+        f"ON CONFLICT(file_name) DO UPDATE SET {', '.join(f'{it} = excluded.{it}' for it in FIELDS[1:])}",
+        [row[it] for it in FIELDS]
+    )
+
+
+def index_file(path: Path) -> Union[Dict, None]:
+    """Parse a playlist from disk and store it, returns None for playlists with a foreign title"""
+    info = read_playlist(path)
+    row = parse_title(info["title"])
+    if row is None:
+        return None
+    stat = path.stat()
+    size = 0
+    for it in info["files"]:
+        try:
+            size += (path.parent / it).stat().st_size
+        except OSError:
+            pass
+    row.update(parse_file_name(path.name))
+    row.update({
+        "file_name": path.name, "duration": info["duration"], "segments": len(info["files"]),
+        "bytes": size, "mtime": stat.st_mtime, "size": stat.st_size
+    })
+    with _lock:
+        _upsert(row)
+        _get_db().commit()
+    return row
+
+
+def add_segments(path: Path, title: str, count: int, duration: float, size: int):
+    """Account newly appended segments of a recording being captured"""
+    row = parse_title(title)
+    if row is None:
+        return
+    stat = path.stat()
+    row.update(parse_file_name(path.name))
+    row.update({"file_name": path.name, "duration": duration, "segments": count, "bytes": size,
+                "mtime": stat.st_mtime, "size": stat.st_size})
+    with _lock:
+        _get_db().execute(
+            f"INSERT INTO recordings ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))}) "
+            "ON CONFLICT(file_name) DO UPDATE SET duration = duration + excluded.duration, "
+            "segments = segments + excluded.segments, bytes = bytes + excluded.bytes, "
+            "mtime = excluded.mtime, size = excluded.size",
+            [row[it] for it in FIELDS]
+        )
+        _get_db().commit()
+
+
+def set_export(title: str, export_file: str, export_bytes: int):
+    """Record the exported file of the recordings with this title, an empty name clears it"""
+    with _lock:
+        _get_db().execute("UPDATE recordings SET export_file = ?, export_bytes = ? WHERE title = ?",
+                         (export_file, export_bytes, title))
+        _get_db().commit()
+
+
+def remove(file_name: str):
+    with _lock:
+        _get_db().execute("DELETE FROM recordings WHERE file_name = ?", (file_name,))
+        _get_db().commit()
+
+
+def get(file_name: str) -> Union[Dict, None]:
+    with _lock:
+        row = _get_db().execute("SELECT * FROM recordings WHERE file_name = ?", (file_name,)).fetchone()
+    return None if row is None else dict(row)
+
+
+def list_all() -> List[Dict]:
+    with _lock:
+        rows = _get_db().execute("SELECT * FROM recordings ORDER BY timestamp DESC").fetchall()
+    return [dict(it) for it in rows]
+
+
+def _encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> List[Any]:
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+def query(filters: Dict[str, Any], sort: List[Tuple[str, bool]], search: Union[str, None] = None,
+          limit: int = 20, offset: int = 0, cursor: Union[str, None] = None) -> Tuple[List[Dict], int, str]:
+    """Filter, sort and page recordings.
+
+    ``sort`` is a list of ``(column, descending)``; ``file_name`` is always appended as a tiebreaker so
+    the returned cursor identifies a unique position. With ``cursor`` the page starts right after that
+    position (keyset pagination) and ``offset`` is ignored.
+    """
+    sort = [(key, desc) for key, desc in sort if key in SORT_KEYS and key != "file_name"]
+    if not sort:
+        sort = [("timestamp", True)]
+    sort.append(("file_name", sort[-1][1]))
+    where = []
+    params = []
+    for key, value in filters.items():
+        if key in INDEXES and value is not None:
+            where.append(f"{key} = ?")
+            params.append(value)
+    if search:
+        pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        where.append("(red LIKE ? ESCAPE '\\' OR blue LIKE ? ESCAPE '\\')")
+        params += [pattern, pattern]
+    count_sql = "SELECT COUNT(*) FROM recordings" + (" WHERE " + " AND ".join(where) if where else "")
+    count_params = list(params)
+    if cursor:
+        values = _decode_cursor(cursor)
+        if not (isinstance(values, list) and len(values) == len(sort) and
+                all(isinstance(it, (str, int, float)) for it in values)):
+            raise ValueError("Cursor does not match the sort order")
+        clauses = []
+        for i, (key, desc) in enumerate(sort):
+            terms = [f"{prev} = ?" for prev, _ in sort[:i]] + [f"{key} {'<' if desc else '>'} ?"]
+            clauses.append("(" + " AND ".join(terms) + ")")
+            params += values[:i + 1]
+        where.append("(" + " OR ".join(clauses) + ")")
+        offset = 0
+    sql = "SELECT * FROM recordings"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY " + ", ".join(f"{key} {'DESC' if desc else 'ASC'}" for key, desc in sort)
+    sql += " LIMIT ? OFFSET ?"
+    params += [limit, offset]
+    with _lock:
+        rows = [dict(it) for it in _get_db().execute(sql, params).fetchall()]
+        total = _get_db().execute(count_sql, count_params).fetchone()[0]
+    next_cursor = _encode_cursor([rows[-1][key] for key, _ in sort]) if rows else ""
+    return rows, total, next_cursor
+
+
+def reconcile(directory: Path):
+    """Bring the catalog in line with the playlists on disk, only re-reading files that changed"""
+    with _lock:
+        known = {it["file_name"]: (it["mtime"], it["size"])
+                 for it in _get_db().execute("SELECT file_name, mtime, size FROM recordings")}
+    present = set()
+    updated = 0
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(".m3u8"):
+            continue
+        present.add(entry.name)
+        stat = entry.stat()
+        if known.get(entry.name) == (stat.st_mtime, stat.st_size):
+            continue
+        try:
+            index_file(Path(entry.path))
+            updated += 1
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot index {entry.name}: {e}")
+    removed = [it for it in known if it not in present]
+    with _lock:
+        _get_db().executemany("DELETE FROM recordings WHERE file_name = ?", [(it,) for it in removed])
+        _get_db().commit()
+    logger.info(f"Catalog reconciled: {len(present)} recordings, {updated} updated, {len(removed)} removed")
+
+
+def reconcile_exports(directory: Path):
+    """Match recordings against the MP4 files present in ``directory``"""
+    present = {entry.name: entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".mp4")}
+    updates = []
+    with _lock:
+        for row in _get_db().execute("SELECT file_name, title, export_file, export_bytes FROM recordings"):
+            name = f"{row['title']}.mp4"
+            if name in present:
+                if (row["export_file"], row["export_bytes"]) != (name, present[name]):
+                    updates.append((name, present[name], row["file_name"]))
+            elif row["export_file"].endswith(".mp4"):
+                updates.append(("", 0, row["file_name"]))
+        _get_db().executemany("UPDATE recordings SET export_file = ?, export_bytes = ? WHERE file_name = ?", updates)
+        _get_db().commit()
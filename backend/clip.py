@@ -1,83 +1,184 @@
-from pathlib import Path
-from datetime import timedelta
 import time
+import bisect
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
 
-import m3u8
-
-data_folder = Path("z:/rmuc record/data2/nuaa")
-
-
-def str_to_timedelta(time_str):
-    hours, minutes, seconds = map(int, time_str.split(':'))
-    return timedelta(hours=hours, minutes=minutes, seconds=seconds)
-
-
-def get_new_name(path: Path):
-    name = path.stem
-    name = name[:name.rfind('_')]
-    name += '_' + str(int(time.time()))
-    # name += '_1722580709'
-    return path.with_name(name + path.suffix)
-
-
-def load_m3u8_file(m3u8_path):
-    with open(m3u8_path, 'r', encoding='utf-8') as f:
-        m3u8_content = f.read()
-    m3u8_obj = m3u8.M3U8(m3u8_content)
-    return m3u8_obj
-
-
-def m3u8_obj_to_str(m3u8_obj, old_path: Path):
-    title = "Null Vs Null"
-    with old_path.open('r', encoding='utf-8') as f:
-        for line in f.readlines():
-            if line.startswith("#TITLE:"):
-                title = line.replace("#TITLE:", "").strip()
-                break
-
-    items = title.split(" ")
-    role = items[3]
-
-    lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:4', '#EXT-X-PLAYLIST-TYPE:VOD',
-             f'#TITLE:南京航空航天大学 Vs 中国石油大学 {role} R2 {str(int(time.time()))}']
-
-    for segment in m3u8_obj.segments:
-        lines.append('#EXTINF:{},'.format(segment.duration))
-        lines.append(segment.uri)
-
-    lines.append('#EXT-X-ENDLIST')
-
-    return '\n'.join(lines)
-
-
-def cut_m3u8_file(m3u8_path, start_time, end_time):
-    # Load the m3u8 file
-    m3u8_obj = load_m3u8_file(str(m3u8_path))
-
-    # Create a new m3u8 object for the cut segments
-    new_m3u8_obj = m3u8.M3U8()
-
-    # Initialize a variable to keep track of the cumulative duration
-    cumulative_duration = timedelta()
-
-    # Iterate over the segments in the m3u8 file
-    for segment in m3u8_obj.segments:
-        # Add the duration of the current segment to the cumulative duration
-        cumulative_duration += timedelta(seconds=segment.duration)
-
-        # Check if the cumulative duration is within the start and end time
-        if start_time <= cumulative_duration <= end_time:
-            # If it is, add the segment to the new m3u8 object
-            new_m3u8_obj.segments.append(segment)
-
-    # Save the new m3u8 object to a file
-    with get_new_name(m3u8_path).open('w', encoding='utf-8') as f:
-        f.write(m3u8_obj_to_str(new_m3u8_obj, m3u8_path))
-
-
-start_time = str_to_timedelta("1:42:00")
-end_time = str_to_timedelta("1:55:00")
-
-
-for it in data_folder.glob("*.m3u8"):
-    cut_m3u8_file(it, start_time, end_time)
+from cachetools import LRUCache
+from pydantic import BaseModel
+
+import config
+import catalog
+from playlist import PlaylistWriter
+from logger import getLogger
+
+logger = getLogger("Clip", "INFO")
+
+_indexes: LRUCache = LRUCache(maxsize=config.clip_cache_size)
+
+
+class ClipReq(BaseModel):
+    start: Union[str, float]
+    end: Union[str, float]
+    file_names: List[str] = []
+    cid: Union[int, None] = None
+    round: Union[int, None] = None
+    roles: Union[List[str], None] = None
+
+
+def parse_time(value: Union[str, float]) -> float:
+    """Seconds from ``H:MM:SS``, ``MM:SS`` or a plain number"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    seconds = 0.
+    for it in value.split(":"):
+        seconds = seconds * 60 + float(it)
+    return seconds
+
+
+def segment_sequence(file_name: str) -> int:
+    return int(file_name.rsplit("-", 1)[1].split(".")[0])
+
+
+class ClipIndex:
+    """Segments of one or more consecutive recordings on a shared timeline.
+
+    ``starts`` and ``ends`` hold the offset of every segment in seconds; recordings are placed by the start
+    time in their file names, so gaps between split recordings are kept. Segments already on the timeline
+    are skipped, which lets earlier clips of the same recording be passed along with it.
+    """
+
+    def __init__(self):
+        self.files: List[str] = []
+        self.durations: List[float] = []
+        self.starts: List[float] = []
+        self.ends: List[float] = []
+
+    def extend(self, other: "ClipIndex", offset: float):
+        seen = set(self.files)
+        for file, duration, start in zip(other.files, other.durations, other.starts):
+            if file in seen:
+                continue
+            start = max(start + offset, self.ends[-1] if self.ends else 0.)
+            self.files.append(file)
+            self.durations.append(duration)
+            self.starts.append(start)
+            self.ends.append(start + duration)
+
+    def find(self, start: float, end: float) -> Tuple[int, int]:
+        """Index range of the segments overlapping ``[start, end)``"""
+        return bisect.bisect_right(self.ends, start), bisect.bisect_left(self.starts, end)
+
+
+def get_index(path: Path) -> ClipIndex:
+    stat = path.stat()
+    key = (path.name, stat.st_mtime_ns, stat.st_size)
+    index = _indexes.get(key)
+    if index is None:
+        index = ClipIndex()
+        position = 0.
+        for file, duration in _read_entries(path):
+            index.files.append(file)
+            index.durations.append(duration)
+            index.starts.append(position)
+            position += duration
+            index.ends.append(position)
+        _indexes[key] = index
+    return index
+
+
+def _read_entries(path: Path) -> List[Tuple[str, float]]:
+    with path.open("r", encoding="utf-8") as f:
+        lines = [it.strip() for it in f]
+    return [(lines[i + 1], float(line.split(":")[1].split(",")[0]))
+            for i, line in enumerate(lines) if line.startswith("#EXTINF:") and i + 1 < len(lines)]
+
+
+def _new_path(prefix: str) -> Path:
+    timestamp = int(time.time())
+    while (config.save_dir / f"{prefix}_{timestamp}.m3u8").exists():
+        timestamp += 1
+    return config.save_dir / f"{prefix}_{timestamp}.m3u8"
+
+
+def cut(recordings: List[Dict], start: float, end: float) -> Union[str, None]:
+    """Write a playlist with the segments of ``recordings`` between ``start`` and ``end`` seconds.
+
+    ``recordings`` are catalog rows sharing one ``{id}_{cid}_{rid}`` prefix, the timeline starts at the
+    earliest of them. Returns the new file name, or None when the window holds no segment.
+    """
+    recordings = sorted(recordings, key=lambda it: it["timestamp"])
+    index = ClipIndex()
+    for it in recordings:
+        index.extend(get_index(config.save_dir / it["file_name"]), it["timestamp"] - recordings[0]["timestamp"])
+    first, last = index.find(start, end)
+    if first >= last:
+        return None
+    path = _new_path(recordings[0]["file_name"].rsplit("_", 1)[0])
+    row = recordings[0]
+    title = f"{row['red']} Vs {row['blue']} {row['role']} R{row['round']} {path.stem.rsplit('_', 1)[1]}"
+    writer = PlaylistWriter(path, title)
+    try:
+        writer.append([(segment_sequence(file), duration, file)
+                       for file, duration in zip(index.files[first:last], index.durations[first:last])])
+    finally:
+        writer.close()
+    catalog.index_file(path)
+    logger.info(f"Clipped {last - first} segments of {title} into {path.name}")
+    return path.name
+
+
+def clip_recordings(file_names: List[str], start: Union[str, float], end: Union[str, float],
+                    align: bool = True) -> List[str]:
+    """Cut the same window out of many recordings in one batch.
+
+    Recordings of the same role and prefix are joined into one timeline first. With ``align`` the window
+    is measured from the earliest recording of the batch, so every role yields the same moment of the
+    round even though the streams started a few seconds apart.
+    """
+    start, end = parse_time(start), parse_time(end)
+    groups: Dict[Tuple[str, str], List[Dict]] = {}
+    for file_name in file_names:
+        row = catalog.get(file_name)
+        if row is None:
+            row = catalog.index_file(config.save_dir / file_name)
+        if row is None:
+            raise ValueError(f"{file_name} is not a recording")
+        groups.setdefault((row["role"], file_name.rsplit("_", 1)[0]), []).append(row)
+    base = min(it["timestamp"] for rows in groups.values() for it in rows) if groups else 0
+    res = []
+    for rows in groups.values():
+        offset = min(it["timestamp"] for it in rows) - base if align else 0
+        file_name = cut(rows, start - offset, end - offset)
+        if file_name is not None:
+            res.append(file_name)
+    return res
+
+
+def clip_round(cid: int, round_: int, start: Union[str, float], end: Union[str, float],
+               roles: Union[List[str], None] = None) -> List[str]:
+    rows, _, _ = catalog.query({"cid": cid, "round": round_}, [("timestamp", False)], limit=-1)
+    return clip_recordings([it["file_name"] for it in rows if roles is None or it["role"] in roles], start, end)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cut a time window out of recordings without copying segments")
+    parser.add_argument("files", nargs="*", help="playlists in save_dir, e.g. 123_19012_3_1714034239.m3u8")
+    parser.add_argument("--cid", type=int, help="cut every recording of this match")
+    parser.add_argument("--round", type=int, help="round of the match, used with --cid")
+    parser.add_argument("--role", action="append", help="only cut these roles, may be repeated")
+    parser.add_argument("--start", required=True, help="window start, H:MM:SS or seconds")
+    parser.add_argument("--end", required=True, help="window end, H:MM:SS or seconds")
+    args = parser.parse_args()
+
+    if args.cid is not None:
+        if args.round is None:
+            parser.error("--round is required with --cid")
+        created = clip_round(args.cid, args.round, args.start, args.end, args.role)
+    elif args.files:
+        created = clip_recordings([Path(it).name for it in args.files], args.start, args.end)
+    else:
+        parser.error("give playlists or --cid and --round")
+    for it in created:
+        print(it)
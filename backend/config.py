@@ -6,6 +6,23 @@ save_dir = Path('z:/rmuc record/data')
 mp4_dir = Path('z:/rmuc record/out')
 
 max_error_count = 20
+segment_concurrency = 4
+poll_min_delay = 0.1
+poll_max_delay = 6
+poll_backoff = 1.5
+stop_grace = 1
+split_segments = 750
+transition_timeout = 5
+start_stagger = 0.1
+storage_workers = 4
+storage_queue_size = 64
+storage_chunk_size = 64 * 1024
+storage_fsync = "none"
+segment_streaming = True
+cdn_pool_limit = 32
+oss_pool_limit = 4
+pool_keepalive = 60
+pool_dns_ttl = 300
 headers = {
     "Accept": "*/*",
     "Accept-Encoding": "gzip, deflate, br, zstd",
@@ -39,8 +56,46 @@ round_info_url = "https://pro-robomasters-hz-n5i3.oss-cn-hangzhou.aliyuncs.com/l
 live_info_url = "https://pro-robomasters-hz-n5i3.oss-cn-hangzhou.aliyuncs.com/live_json/live_game_info.json"
 
 reqs_json = Path("reqs.json")
+catalog_db = Path("catalog.db")
+watch_interval = 2
+feed_queue_size = 256
+feed_keepalive = 15
+# signing key of segment URLs, str or bytes; None keeps a generated one in hls_secret_file
+hls_secret = None
+hls_secret_file = Path("hls_secret")
+hls_token_ttl = 24 * 3600
+hls_cache_size = 64
+ffmpeg_path = "ffmpeg"
+transcode_workers = 2
+transcode_history = 100
+concat_workers = 2
+auto_remux = False
+auto_remux_format = "mp4"
+auto_remux_workers = 1
+auto_remux_readrate = 10
+auto_remux_io_limit = 32 * 1024 * 1024
+auto_remux_nice = 10
+auto_verify = False
+verify_refetch = True
+verify_workers = 1
+verify_nice = 10
+verify_history = 100
+metrics_rate_window = 10
+metrics_latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+metrics_write_buckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1]
+clip_cache_size = 64
+upload_workers = 1
+upload_page_concurrency = 2
+upload_rate_limit = 0
+upload_retries = 3
+upload_retry_delay = 5
+upload_history = 50
+bili_info_ttl = 300
 
+# True or "on": every request needs a login, "admin": only admin paths do, False or "off": no login
 basic_security = True
+auth_exempt_path = []
+auth_cache_size = 32
 username = b"nuaanuaa"
 password = b"ckyfckyf"
 
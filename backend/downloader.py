@@ -1,16 +1,24 @@
 import time
-from typing import List, Union
+from datetime import datetime
+from pathlib import Path
+from typing import List, Set, Tuple, Union
 import random
 import asyncio
 import re
+import sqlite3
 
 import aiohttp
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.job import Job
 from pydantic import BaseModel
 
 import config
+import catalog
+import http_pool
+import metrics
+import transcode
+import verify
 from logger import getLogger
+from playlist import PlaylistWriter
+from storage import SegmentStorage
 
 
 name_regex = re.compile(r"/(\d+_\d+)\.ts")
@@ -34,6 +42,55 @@ role2code = {
 class Segment(BaseModel):
     duration: float
     uri: str
+    name: str = ""
+    sequence: int = -1
+    program_time: float = 0
+    size: int = 0
+
+    @classmethod
+    def parse(cls, duration: float, uri: str, program_time: float = 0) -> "Segment":
+        name = name_regex.findall(uri)[0]
+        return cls(duration=duration, uri=uri, name=name, sequence=int(name.split("_")[-1]),
+                   program_time=program_time)
+
+
+class TruncatedSegment(Exception):
+    pass
+
+
+class MediaPlaylist(BaseModel):
+    target_duration: float = 3
+    media_sequence: int = 0
+    can_block_reload: bool = False
+    segments: List[Segment] = []
+
+    @property
+    def last_msn(self) -> int:
+        """Sequence number of the newest segment, read from its name so a missing MEDIA-SEQUENCE tag is harmless"""
+        if self.segments:
+            return self.segments[-1].sequence
+        return self.media_sequence - 1
+
+
+def parse_playlist(text: str) -> MediaPlaylist:
+    playlist = MediaPlaylist()
+    lines = text.split("\n")
+    program_time = 0.
+    for i in range(len(lines)):
+        line = lines[i].replace(' ', '')
+        if line.startswith("#EXTINF"):
+            duration = float(line.split(":")[1].split(",")[0])
+            playlist.segments.append(Segment.parse(duration, lines[i + 1], program_time))
+            program_time = 0.
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            playlist.target_duration = float(line.split(":")[1])
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            playlist.media_sequence = int(line.split(":")[1])
+        elif line.startswith("#EXT-X-SERVER-CONTROL:"):
+            playlist.can_block_reload = "CAN-BLOCK-RELOAD=YES" in line
+        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+            program_time = datetime.fromisoformat(line.split(":", 1)[1]).timestamp()
+    return playlist
 
 
 class RoundInfo(BaseModel):
@@ -49,105 +106,263 @@ class RoundInfo(BaseModel):
 
 
 class Downloader:
-    def __init__(self, name: str, url: str, scheduler: AsyncIOScheduler):
+    def __init__(self, name: str, url: str):
         self.name = name
         self.id = random.randint(0, 100000)
         self.cid = -1
         self.rid = 1
         self.title = "Null Vs Null R0"
-        self.processing = False
         self.url = url
         self.error_count = 0
-        self.scheduler = scheduler
-        self.connector = aiohttp.TCPConnector(limit=4)
         self.start_time = time.time()
-        self.session = aiohttp.ClientSession(
-            connector=self.connector,
-            headers=config.headers,
-            timeout=aiohttp.ClientTimeout(total=10)
-        )
+        self.session = http_pool.get_session("cdn")
+        self.storage = SegmentStorage(self.name)
+        self.metrics = metrics.StreamMetrics(role2code.get(name, name), self.storage.stats)
+        self.storage.on_write = self.metrics.write_latency.observe
 
         self.segments: List[Segment] = []
-        self.job: Union[Job, None] = None
+        self.held: List[Segment] = []
+        self.saved = 0
+        self.writer: Union[PlaylistWriter, None] = None
+        self.seen: Set[str] = set()
+        self.inflight: Set[str] = set()
+        self.window_start = -1
+        self.unchanged = 0
+        self.last_msn = -1
+        self.last_poll = 0.
+        self.downloading = False
+        self.block_reload = False
+        self.target_duration = 4.
+        self.updated = asyncio.Condition()
+        self.checks: Set[asyncio.Task] = set()
+        self.task: Union[asyncio.Task, None] = None
+        self.stop_event = asyncio.Event()
         self.logger = getLogger(f"DL-{role2code.get(self.name, self.name)}", "INFO")
         
-    async def start(self, info: RoundInfo):
-        if self.job is not None:
+    async def start(self, info: RoundInfo, delay: float = 0):
+        if self.task is not None:
             await self.end()
         self.cid = info.id
         self.rid = info.round
-        self.segments = []
+        await self._finish()
+        self.seen = set()
+        self.window_start = -1
+        self.last_msn = -1
         self.start_time = time.time()
+        self.metrics.start()
         self.title = f"{info.red} Vs {info.blue} {self.name} R{info.round}"
-        self.job = self.scheduler.add_job(self._get_m3u8_info, "interval", seconds=3)
+        self._run(delay)
         self.logger.info(f"Start {self.name} {self.title}")
         self.logger.info(f"URL: {self.url}")
 
     async def split(self):
-        await self.end()
+        await self._save()
         self.start_time = time.time()
-        self.job = self.scheduler.add_job(self._get_m3u8_info, "interval", seconds=3)
+        await self._finish()
         self.logger.info(f"Split {self.name} {self.title}")
 
     async def end(self):
-        if self.job is not None:
+        task = self.task
+        if task is not None:
             self.logger.info(f"End {self.name} {self.title}")
-            self.job.remove()
-            self.job = None
-        while self.processing:
-            await asyncio.sleep(1)
+            self.task = None
+            self.metrics.recording = False
+            self.stop_event.set()
+            await self._notify()
+            if task is not asyncio.current_task():
+                done, _ = await asyncio.wait([task], timeout=config.stop_grace)
+                if not done and self.downloading:
+                    # the last segments of the round are still coming in, only a pending poll is dropped
+                    done, _ = await asyncio.wait([task], timeout=self.target_duration)
+                if not done:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+        await self._commit(self.held)
+        self.held = []
         await self._save()
-        self.segments = []
+        await self._finish()
 
     async def close(self):
         await self.end()
-        await self.connector.close()
-        await self.session.close()
+        await asyncio.gather(*self.checks, return_exceptions=True)
+        await self.storage.close()
         self.logger.info(f"Close {self.name}")
 
+    def _run(self, delay: float = 0):
+        self.stop_event = asyncio.Event()
+        self.task = asyncio.create_task(self._capture(self.stop_event, delay), name=f"DL-{self.name}")
+        self.task.add_done_callback(self._on_capture_done)
+
+    def _on_capture_done(self, task: asyncio.Task):
+        if task.cancelled() or task is not self.task:
+            return
+        self.logger.error(f"Capture task of {self.name} exited: {task.exception()}, restarting")
+        self.error_count += 1
+        self._run()
+
+    async def _capture(self, stop_event: asyncio.Event, delay: float):
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=delay)
+                break
+            except asyncio.TimeoutError:
+                pass
+            delay = await self._get_m3u8_info()
+
     async def _save(self):
-        if not self.segments:
+        if len(self.segments) <= self.saved:
             return
-        with open(config.save_dir / f"{self.id}_{self.cid}_{self.rid}_{int(self.start_time)}.m3u8", "w", encoding="utf-8") as f:
-            f.write("#EXTM3U\n")
-            f.write("#EXT-X-TARGETDURATION:4\n")
-            f.write("#EXT-X-PLAYLIST-TYPE:VOD\n")
-            f.write(f"#TITLE:{self.title} {int(time.time())}\n")
-            last_id = -1
-            for segment in self.segments:
-                id_ = int(name_regex.findall(segment.uri)[0].split("_")[-1])
-                if id_ != last_id + 1 and last_id != -1:
-                    f.write("#EXT-X-DISCONTINUITY\n")
-                f.write(f"#EXTINF:{segment.duration},\n")
-                f.write(f"{self._get_segment_name(segment)}\n")
-                last_id = id_
-            f.write("#EXT-X-ENDLIST\n")
+        if self.writer is None:
+            self.writer = PlaylistWriter(config.save_dir / self.playlist_name(), f"{self.title} {int(time.time())}")
+        segments = self.segments[self.saved:]
+        entries = [(segment.sequence, segment.duration, self.get_segment_name(segment)) for segment in segments]
+        self.saved = len(self.segments)
+        await self.storage.call(self._append, self.writer, entries,
+                                sum(it.duration for it in segments), sum(it.size for it in segments))
         self.logger.debug(f"Save {self.name} {self.title}")
 
-    async def _get_m3u8_info(self):
-        if self.processing:
-            self.error_count += 1
-            self.logger.error(f"M3U8 processing timeout")
-            return
+    def _append(self, writer: PlaylistWriter, entries: List[Tuple[int, float, str]], duration: float, size: int):
+        writer.append(entries)
+        try:
+            catalog.add_segments(writer.path, writer.title, len(entries), duration, size)
+        except sqlite3.Error as e:
+            self.logger.error(f"Catalog update failed: {e}")
+
+    async def _finish(self):
+        writer = self.writer
+        duration = self.metrics.recorded
+        self.metrics.recorded = 0.
+        self.writer = None
+        self.segments = []
+        self.saved = 0
+        await self._notify()
+        if writer is not None:
+            await self.storage.call(writer.close)
+            if config.auto_verify:
+                task = asyncio.create_task(self._check(writer, duration), name=f"Verify-{writer.path.name}")
+                self.checks.add(task)
+                task.add_done_callback(self.checks.discard)
+            elif config.auto_remux:
+                await self._remux(writer, duration)
+
+    async def _check(self, writer: PlaylistWriter, duration: float):
+        """Verify a finished recording and fill its gaps from the CDN window before it is remuxed"""
+        try:
+            report = await verify.verify_async(writer.path)
+            self.logger.info(f"Verified {writer.path.name} in {report.elapsed:.2f}s: {report.missing} missing, "
+                             f"{report.pcr_jumps} PCR jumps, {len(report.bad)} damaged segments")
+            if report.missing and config.verify_refetch:
+                duration += await self._refetch(writer, report)
+        except Exception as e:
+            self.logger.error(f"Cannot verify {writer.path.name}: {e}")
+        if config.auto_remux:
+            await self._remux(writer, duration)
+
+    async def _refetch(self, writer: PlaylistWriter, report: verify.RecordingReport) -> float:
+        """Download the missing segments still listed by the CDN, returns the duration added"""
+        async with self.session.get(self.url) as response:
+            response.raise_for_status()
+            playlist = parse_playlist(await response.text())
+        prefix = writer.path.name.rsplit("_", 1)[0]
+        window = {f"{prefix}_{it.name.replace('_', '-')}.ts": it for it in playlist.segments}
+        recorded = await self.storage.call(verify.read_entries, writer.path)
+        fills = {}
+        for (first, _, before), (last, _, after) in zip(recorded, recorded[1:]):
+            # only gaps next to a segment the CDN still lists are in its current numbering
+            if last <= first + 1 or not (before in window or after in window):
+                continue
+            for name, segment in window.items():
+                if not first < segment.sequence < last:
+                    continue
+                try:
+                    await self._fetch(segment, config.save_dir / name)
+                except Exception as e:
+                    self.logger.error(f"Cannot refetch {segment.uri}: {e}")
+                    continue
+                fills.setdefault(before, []).append((segment.sequence, segment.duration, name))
+        if fills:
+            await self.storage.call(verify.insert_segments, writer.path, fills)
+        added = [it for gap in fills.values() for it in gap]
+        self.logger.info(f"Refetched {len(added)} of {report.missing} missing segments of {writer.path.name}")
+        return sum(it[1] for it in added)
+
+    async def _remux(self, writer: PlaylistWriter, duration: float):
+        try:
+            await transcode.jobs.submit(writer.path.name, writer.title, duration, config.auto_remux_format, auto=True)
+        except (sqlite3.Error, ValueError) as e:
+            self.logger.error(f"Cannot queue remux of {writer.path.name}: {e}")
+
+    def playlist_name(self) -> str:
+        return f"{self.id}_{self.cid}_{self.rid}_{int(self.start_time)}.m3u8"
+
+    async def _notify(self):
+        async with self.updated:
+            self.updated.notify_all()
+
+    async def wait_segments(self, count: int, timeout: float) -> bool:
+        """Block until the current recording holds ``count`` segments, it is replaced or capture stops"""
+        name = self.playlist_name()
+        async with self.updated:
+            try:
+                await asyncio.wait_for(self.updated.wait_for(
+                    lambda: len(self.segments) >= count or self.task is None or self.playlist_name() != name
+                ), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def _playlist_url(self) -> str:
+        if not self.block_reload or self.last_msn < 0:
+            return self.url
+        return f"{self.url}{'&' if '?' in self.url else '?'}_HLS_msn={self.last_msn + 1}"
+
+    def _next_delay(self, playlist: MediaPlaylist) -> float:
+        if playlist.last_msn > self.last_msn:
+            self.unchanged = 0
+            if self.block_reload:
+                return config.poll_min_delay
+            return playlist.segments[-1].duration if playlist.segments else playlist.target_duration
+        self.unchanged += 1
+        delay = playlist.target_duration / 2 * config.poll_backoff ** (self.unchanged - 1)
+        return max(config.poll_min_delay, min(delay, config.poll_max_delay))
+
+    def _update_latency(self, segments: List[Segment], previous_poll: float):
+        now = time.time()
+        for segment in segments:
+            if segment.program_time:
+                latency = now - segment.program_time - segment.duration
+            else:
+                latency = now - previous_poll
+            stats = self.metrics
+            stats.latency = latency if stats.latency == 0 else stats.latency * 0.9 + latency * 0.1
+
+    async def _get_m3u8_info(self) -> float:
         self.logger.debug(f"Getting m3u8 info")
+        delay = config.poll_max_delay
         try:
-            self.processing = True
-            async with self.session.get(self.url) as response:
-                text = await response.text()
-                lines = text.split("\n")
-                duration = 3
-                segments = []
-                for i in range(len(lines)):
-                    line = lines[i].replace(' ', '')
-                    if line.startswith("#EXTINF"):
-                        duration = float(line.split(":")[1].split(",")[0])
-                        segments.append(Segment(duration=duration, uri=lines[i + 1]))
-                if self.job is not None:
-                    self.job.reschedule("interval", seconds=duration)
-                await self._download_segments(segments)
-                await self._save()
-            if len(segments) > 750:
-                self.processing = False
+            previous_poll = self.last_poll or time.time()
+            self.last_poll = time.time()
+            self.metrics.polls += 1
+            async with self.session.get(self._playlist_url()) as response:
+                response.raise_for_status()
+                playlist = parse_playlist(await response.text())
+            self.metrics.poll_latency.observe(time.time() - self.last_poll)
+            self.block_reload = playlist.can_block_reload
+            self.target_duration = playlist.target_duration
+            if playlist.segments and playlist.last_msn < self.last_msn:
+                self.logger.warning(f"Media sequence went back from {self.last_msn} to {playlist.last_msn}")
+                self.last_msn = -1
+            delay = self._next_delay(playlist)
+            self.last_msn = max(self.last_msn, playlist.last_msn)
+            saved = len(self.segments)
+            self.downloading = True
+            try:
+                await self._download_segments(playlist.segments)
+            finally:
+                self.downloading = False
+            await self._save()
+            self._update_latency(self.segments[saved:], previous_poll)
+            if len(self.segments) > config.split_segments:
                 await self.split()
         except aiohttp.ClientResponseError as e:
             self.logger.error(f"Error {e.status} on {self.name}")
@@ -155,53 +370,110 @@ class Downloader:
                 await self.end()
             else:
                 self.error_count += 1
+                self.metrics.errors += 1
                 if self.error_count > config.max_error_count:
                     self.logger.fatal(f"Error count exceed {config.max_error_count} on {self.name}")
                     self.error_count = 0
                     await self.split()
         except Exception as e:
             self.logger.error(f"Error {e} on {self.name}")
-        finally:
-            self.processing = False
-            
-    def _get_segment_name(self, segment: Segment):
-        id_ = name_regex.findall(segment.uri)[0].replace("_", "-")
+            self.metrics.errors += 1
+        return delay
+
+    def get_segment_name(self, segment: Segment):
+        id_ = segment.name.replace("_", "-")
         return f"{self.id}_{self.cid}_{self.rid}_{id_}.ts"
                     
-    async def _download_segment(self, segment: Segment):
-        already = [s.uri for s in self.segments[-5:]]
-        if segment.uri in already:
-            return
-        self.logger.debug(f"Downloading {segment.uri}")
+    async def _fetch(self, segment: Segment, path: Path) -> int:
+        """Download one segment to ``path`` through the storage stage, returns its size"""
         async with self.session.get(f"https://rtmp.djicdn.com/robomaster/{segment.uri}") as response:
-            filename = config.save_dir / self._get_segment_name(segment)
-            with open(filename, "wb") as f:
-                f.write(await response.read())
-            self.segments.append(segment)
-        
-    async def _download_segments(self, segments: List[Segment]):
-        for segment in segments:
+            response.raise_for_status()
+            file = await self.storage.open(path)
+            try:
+                if config.segment_streaming:
+                    async for chunk in response.content.iter_chunked(config.storage_chunk_size):
+                        await file.write(chunk)
+                else:
+                    await file.write(await response.read())
+                expected = response.content_length
+                if expected is not None and "Content-Encoding" not in response.headers and file.size != expected:
+                    raise TruncatedSegment(f"{segment.uri} got {file.size} of {expected} bytes")
+            except BaseException:
+                await file.abort()
+                raise
+            await file.close()
+        return file.size
+
+    async def _download_segment(self, segment: Segment) -> bool:
+        self.logger.debug(f"Downloading {segment.uri}")
+        begin = time.perf_counter()
+        segment.size = await self._fetch(segment, config.save_dir / self.get_segment_name(segment))
+        self.metrics.fetch_latency.observe(time.perf_counter() - begin)
+        self.seen.add(segment.name)
+        return True
+
+    async def _fetch_segment(self, segment: Segment, semaphore: asyncio.Semaphore) -> bool:
+        async with semaphore:
             try:
-                await self._download_segment(segment)
+                return await self._download_segment(segment)
             except Exception as _:
                 try:
-                    await self._download_segment(segment)
+                    return await self._download_segment(segment)
                 except aiohttp.ClientResponseError as e:
-                    self.logger.error(e.status, e.message)
+                    self.logger.error(f"Error {e.status} {e.message} on {segment.uri}")
                     self.error_count += 1
+                    self.metrics.errors += 1
                 except Exception as e:
                     self.logger.error(e)
+                    self.metrics.errors += 1
+            finally:
+                self.inflight.discard(segment.name)
+        return False
+
+    async def _commit(self, segments: List[Segment]):
+        if not segments:
+            return
+        self.segments.extend(segments)
+        self.metrics.add_segments([it.sequence for it in segments], sum(it.duration for it in segments),
+                                  sum(it.size for it in segments))
+        await self._notify()
+
+    async def _download_segments(self, segments: List[Segment]):
+        if segments and segments[-1].sequence < self.window_start:
+            # the whole window is behind the last one: the CDN restarted its numbering and names seen
+            # before may come round again
+            self.logger.warning(f"Sequence reset from {self.window_start} to {segments[0].sequence} on {self.name}")
+            await self._commit(self.held)
+            self.held = []
+            self.seen = set()
+        if segments:
+            self.window_start = segments[0].sequence
+        pending = []
+        for segment in segments:
+            if segment.name in self.seen or segment.name in self.inflight:
+                self.metrics.skipped += 1
+                continue
+            self.inflight.add(segment.name)
+            pending.append(segment)
+        semaphore = asyncio.Semaphore(max(1, config.segment_concurrency))
+        results = await asyncio.gather(*[self._fetch_segment(segment, semaphore) for segment in pending])
+        done = sorted(self.held + [segment for segment, ok in zip(pending, results) if ok], key=lambda it: it.sequence)
+        # segments after one that failed wait for its retry on the next poll, until it leaves the CDN window
+        missing = min((it.sequence for it in segments if it.name not in self.seen), default=None)
+        split = len(done) if missing is None else next((i for i, it in enumerate(done) if it.sequence > missing),
+                                                       len(done))
+        self.held = done[split:]
+        await self._commit(done[:split])
+        if segments and len(self.seen) > 4 * len(segments):
+            self.seen &= {it.name for it in segments}
 
 
 if __name__ == "__main__":
     async def main():
-        scheduler = AsyncIOScheduler()
-        scheduler.start()
-        downloader = Downloader("主视角", "https://rtmp.djicdn.com/robomaster/ual2024-beibu.m3u8?auth_key=1714034239-0-0-58bb9500239eec501606d2dab3004f66", scheduler)
+        downloader = Downloader("主视角", "https://rtmp.djicdn.com/robomaster/ual2024-beibu.m3u8?auth_key=1714034239-0-0-58bb9500239eec501606d2dab3004f66")
         await downloader.start(RoundInfo(red="同济大学", blue="齐鲁工业大学", round=3, id=19012))
         await asyncio.sleep(60)
         await downloader.close()
-        scheduler.shutdown()
+        await http_pool.close()
 
     asyncio.run(main())
-
@@ -0,0 +1,132 @@
+import os
+import hmac
+import math
+import time
+import hashlib
+import secrets
+from typing import List, Tuple
+
+from cachetools import LRUCache
+
+import config
+import playlist
+
+TOKEN_PATH = "/api/hls/s/"
+
+_cache: LRUCache = LRUCache(maxsize=config.hls_cache_size)
+
+
+def _load_secret() -> bytes:
+    """``hls_secret``, or a key generated once and kept in ``hls_secret_file``.
+
+    Signed URLs are cached as immutable, so the key has to survive restarts and be the same in every worker.
+    """
+    if config.hls_secret:
+        return config.hls_secret.encode() if isinstance(config.hls_secret, str) else config.hls_secret
+    path = config.hls_secret_file
+    if not path.exists():
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(secrets.token_bytes(32))
+        try:
+            # link fails if another worker created the file first, then its key wins
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink()
+    return path.read_bytes()
+
+
+_secret = _load_secret()
+
+
+def recording_prefix(file_name: str) -> str:
+    """``{id}_{cid}_{rid}``, shared by a playlist and all of its segments"""
+    return file_name.rsplit("_", 1)[0]
+
+
+def sign(prefix: str, expires: int) -> str:
+    return hmac.new(_secret, f"{prefix}:{expires}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def verify(prefix: str, expires: int, signature: str) -> bool:
+    return expires > time.time() and hmac.compare_digest(sign(prefix, expires), signature)
+
+
+def segment_base(file_name: str) -> str:
+    """Signed URL prefix for the segments of a recording.
+
+    The expiry is rounded up to whole token periods so every playlist request within a period yields the
+    same segment URLs, which lets browsers and proxies cache them.
+    """
+    prefix = recording_prefix(file_name)
+    period = config.hls_token_ttl
+    expires = (int(time.time()) // period + 2) * period
+    return f"{TOKEN_PATH}{prefix}/{expires}/{sign(prefix, expires)}/"
+
+
+def _read(file_name: str) -> List[str]:
+    with (config.save_dir / file_name).open("r", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def render(file_name: str) -> Tuple[str, bool]:
+    """Rewrite a recording playlist with signed segment URLs, returns the text and whether it is live"""
+    stat = (config.save_dir / file_name).stat()
+    live = file_name in playlist.open_playlists
+    base = segment_base(file_name)
+    key = (file_name, stat.st_mtime_ns, stat.st_size, live, base)
+    text = _cache.get(key)
+    if text is not None:
+        return text, live
+    lines = []
+    for line in _read(file_name):
+        if not line:
+            continue
+        if line.startswith("#EXT-X-PLAYLIST-TYPE:") and live:
+            line = "#EXT-X-PLAYLIST-TYPE:EVENT"
+        elif line == "#EXT-X-ENDLIST" and live:
+            continue
+        elif not line.startswith("#"):
+            line = base + line
+        lines.append(line)
+    text = "\n".join(lines) + "\n"
+    _cache[key] = text
+    return text, live
+
+
+def render_live(downloader) -> str:
+    """EVENT playlist of the recording a Downloader is capturing, built from its in-memory segments.
+
+    Media sequence numbers count segments from the start of the recording, so ``_HLS_msn`` maps directly
+    to ``len(downloader.segments)``.
+    """
+    file_name = downloader.playlist_name()
+    segments = downloader.segments
+    base = segment_base(file_name)
+    ended = downloader.task is None
+    key = ("live", file_name, len(segments), ended, base)
+    text = _cache.get(key)
+    if text is not None:
+        return text
+    target = max([downloader.target_duration] + [it.duration for it in segments])
+    lines = [
+        "#EXTM3U",
+        f"#EXT-X-TARGETDURATION:{math.ceil(target)}",
+        "#EXT-X-PLAYLIST-TYPE:EVENT",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES",
+        f"#TITLE:{downloader.title}",
+    ]
+    last = -1
+    for segment in segments:
+        if last != -1 and segment.sequence != last + 1:
+            lines.append("#EXT-X-DISCONTINUITY")
+        lines.append(f"#EXTINF:{segment.duration},")
+        lines.append(base + downloader.get_segment_name(segment))
+        last = segment.sequence
+    if ended:
+        lines.append("#EXT-X-ENDLIST")
+    text = "\n".join(lines) + "\n"
+    _cache[key] = text
+    return text
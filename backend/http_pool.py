@@ -0,0 +1,127 @@
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Union
+
+import aiohttp
+from pydantic import BaseModel
+
+import config
+from logger import getLogger
+
+logger = getLogger("HttpPool", "INFO")
+
+
+class PoolStats(BaseModel):
+    name: str
+    requests: int = 0
+    new_connections: int = 0
+    reused_connections: int = 0
+    handshake_time: float = 0
+    not_modified: int = 0
+
+
+class HostPool:
+    def __init__(self, name: str, headers: Dict[str, str], limit_per_host: int):
+        self.name = name
+        self.headers = headers
+        self.limit_per_host = limit_per_host
+        self.stats = PoolStats(name=name)
+        self.handshake_total = 0.
+        self.session: Union[aiohttp.ClientSession, None] = None
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(_, __, ___):
+            self.stats.requests += 1
+
+        async def on_connection_create_start(_, ctx: SimpleNamespace, __):
+            ctx.connect_start = time.perf_counter()
+
+        async def on_connection_create_end(_, ctx: SimpleNamespace, __):
+            self.stats.new_connections += 1
+            self.handshake_total += time.perf_counter() - ctx.connect_start
+            self.stats.handshake_time = round(self.handshake_total / self.stats.new_connections * 1000, 2)
+
+        async def on_connection_reuseconn(_, __, ___):
+            self.stats.reused_connections += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_start.append(on_connection_create_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=config.pool_keepalive,
+                ttl_dns_cache=config.pool_dns_ttl,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=10),
+                trace_configs=[self._trace_config()]
+            )
+            logger.info(f"Open {self.name} pool")
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            logger.info(f"Close {self.name} pool")
+
+
+pools: Dict[str, HostPool] = {
+    "cdn": HostPool("cdn", config.headers, config.cdn_pool_limit),
+    "oss": HostPool("oss", config.oss_headers, config.oss_pool_limit),
+}
+
+
+class CachedResource:
+    """A polled resource fetched with If-None-Match/If-Modified-Since.
+
+    ``parse`` only runs when the body changed; a 304 returns the previously parsed value.
+    """
+
+    def __init__(self, pool: str, url: str, parse: Callable[[bytes], Any]):
+        self.pool = pool
+        self.url = url
+        self.parse = parse
+        self.etag: Union[str, None] = None
+        self.last_modified: Union[str, None] = None
+        self.value: Any = None
+
+    async def get(self) -> Any:
+        headers = {}
+        if self.value is not None:
+            if self.etag is not None:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified is not None:
+                headers["If-Modified-Since"] = self.last_modified
+        async with get_session(self.pool).get(self.url, headers=headers) as response:
+            if response.status == 304 and self.value is not None:
+                pools[self.pool].stats.not_modified += 1
+                return self.value
+            response.raise_for_status()
+            value = self.parse(await response.read())
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+            self.value = value
+            return value
+
+
+def get_session(name: str) -> aiohttp.ClientSession:
+    return pools[name].get_session()
+
+
+def get_stats() -> List[PoolStats]:
+    return [pool.stats for pool in pools.values()]
+
+
+async def close():
+    for pool in pools.values():
+        await pool.close()
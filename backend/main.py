@@ -1,28 +1,52 @@
 import re
-import secrets
-import base64
+import asyncio
 from typing import List
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Path, Request
+from fastapi import FastAPI, Path, Query, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse, Response
 from bilibili_api.login_func import QrCodeLoginEvents
 
 import config
+import auth
+import catalog
+import http_pool
+import hls_gateway
+import transcode
+import clip
+import upload
+import verify
+import metrics
+import watcher
 from logger import setUvicornLogger
 from range_response import RangeResponse
+from playlist import repair_all
+from storage import remove_partial
 from manager import Manager, get_live_info, LiveStreamReq
 from video import filter_video_list, VideoFilterProps, get_video_info, convert_to_mp4, delete_file
-from bilibili_helper import login, check, get_username, upload_video
+from bilibili_helper import login, check, get_username, upload_video, BilibiliUploader
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    repair_all(config.save_dir)
+    remove_partial(config.save_dir)
+    remove_partial(config.mp4_dir)
+    await asyncio.to_thread(catalog.reconcile, config.save_dir)
+    await asyncio.to_thread(catalog.reconcile_exports, config.mp4_dir)
+    watch_task = asyncio.create_task(watcher.watch())
+    await transcode.jobs.start()
+    await upload.jobs.start(BilibiliUploader)
     await manager.init()
     setUvicornLogger("INFO")
     yield
+    watch_task.cancel()
+    await transcode.jobs.close()
+    await upload.jobs.close()
     await manager.close()
+    verify.close()
+    await http_pool.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -34,52 +58,13 @@ staticFiles = StaticFiles(directory='static')
 app.mount("/static", staticFiles, name="static")
 
 
-def check_permission(info):
-    info = info.replace("Basic ", "")
-    current_username_bytes, current_password_bytes = base64.b64decode(info).decode().split(':', 1)
-    is_admin_correct_username = secrets.compare_digest(current_username_bytes.encode(), config.admin_username)
-    is_admin_correct_password = secrets.compare_digest(current_password_bytes.encode(), config.admin_password)
-    is_correct_username = secrets.compare_digest(current_username_bytes.encode(), config.username)
-    is_correct_password = secrets.compare_digest(current_password_bytes.encode(), config.password)
-    is_user = is_correct_username and is_correct_password
-    is_admin = is_admin_correct_username and is_admin_correct_password
-    return is_user or is_admin, is_admin
-
-
-admin_path = [
-    '/api/video/delete', '/api/video/convert', '/api/video/upload', '/api/bili', '/api/manager/delete',
-    '/api/manager/add', '/api/manager/update', '/api/manager/start', '/api/manager/end'
-]
-
-
 @app.middleware("http")
 async def check_auth(request: Request, call_next):
-    if config.basic_security == "on":
-        if "Authorization" not in request.headers:
-            return JSONResponse(None, 401, {"WWW-Authenticate": "Basic"})
-        is_user, is_admin = check_permission(request.headers["Authorization"])
-        if not is_user:
-            return JSONResponse(None, 401, {"WWW-Authenticate": "Basic"})
-        need_admin = False
-        for path in admin_path:
-            if request.url.path.startswith(path):
-                need_admin = True
-                break
-        if need_admin and not is_admin:
-            return JSONResponse({"msg": "Need Admin Permission"}, 401, {"WWW-Authenticate": "Basic"})
-    elif config.basic_security == "admin":
-        need_admin = False
-        for path in admin_path:
-            if request.url.path.startswith(path):
-                need_admin = True
-                break
-        if not need_admin:
-            return await call_next(request)
-        if "Authorization" not in request.headers:
-            return JSONResponse(None, 401, {"WWW-Authenticate": "Basic"})
-        is_user, is_admin = check_permission(request.headers["Authorization"])
-        if not is_admin:
-            return JSONResponse({"msg": "Need Admin Permission"}, 401, {"WWW-Authenticate": "Basic"})
+    res = auth.check(request.url.path, request.headers.get("Authorization"))
+    if res == auth.NEED_LOGIN:
+        return JSONResponse(None, 401, {"WWW-Authenticate": "Basic"})
+    if res == auth.NEED_ADMIN:
+        return JSONResponse({"msg": "Need Admin Permission"}, 401, {"WWW-Authenticate": "Basic"})
     return await call_next(request)
 
 
@@ -93,11 +78,22 @@ async def get_manager():
     return manager.get()
 
 
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render([it.metrics for it in manager.downloaders.values() if it is not None]),
+                    media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/api/manager/live")
 async def get_manager():
     return await get_live_info()
 
 
+@app.get("/api/manager/pool")
+async def get_pool_stats():
+    return http_pool.get_stats()
+
+
 @app.get("/api/manager/delete")
 async def delete_manager(role: str):
     await manager.delete_req(role)
@@ -130,19 +126,76 @@ async def manual_end():
 
 @app.post("/api/video/list")
 async def get_video(props: VideoFilterProps):
-    return filter_video_list(**props.dict())
+    try:
+        return filter_video_list(**props.dict())
+    except ValueError:
+        return JSONResponse({"code": -1, "msg": "Illegal cursor"}, 400)
+
+
+@app.get("/api/video/events")
+async def video_events():
+    return StreamingResponse(watcher.feed.subscribe(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get("/api/video/convert/{file_name}")
-async def convert_video(file_name: str = Path()):
+async def convert_video(file_name: str = Path(), wait: bool = False, format: str = "mp4"):
     if not path_regex.match(file_name):
         return JSONResponse({"code": -1, "msg": "Illegal file name"}, 400)
+    if format not in ("mp4", "ts"):
+        return JSONResponse({"code": -1, "msg": "Illegal format"}, 400)
     if not (config.save_dir / file_name).exists():
         return JSONResponse({"code": 2, "msg": "M3U8 file not exist."}, 404)
-    mp4 = config.mp4_dir / f"{get_video_info(file_name).title}.mp4"
-    if not mp4.exists():
-        await convert_to_mp4(get_video_info(file_name))
-    return {"code": 0}
+    video = get_video_info(file_name)
+    if transcode.output_path(video.title, format).exists():
+        return {"code": 0}
+    job = await convert_to_mp4(video, wait, format)
+    if job.status == "failed":
+        return JSONResponse({"code": 3, "msg": job.error, "job": job.dict()}, 500)
+    return {"code": 0, "job": job.dict()}
+
+
+@app.get("/api/transcode")
+async def get_transcode_jobs():
+    return {"jobs": transcode.jobs.get_jobs(), "stats": transcode.jobs.get_stats()}
+
+
+@app.get("/api/transcode/{job_id}")
+async def get_transcode_job(job_id: int):
+    job = transcode.jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"code": 2, "msg": "Job not exist."}, 404)
+    return job
+
+
+@app.get("/api/video/verify/{file_name}")
+async def verify_video(file_name: str = Path()):
+    if not path_regex.match(file_name):
+        return JSONResponse({"code": -1, "msg": "Illegal file name"}, 400)
+    if not (config.save_dir / file_name).exists():
+        return JSONResponse({"code": 2, "msg": "M3U8 file not exist."}, 404)
+    return await verify.verify_async(config.save_dir / file_name)
+
+
+@app.get("/api/verify")
+async def get_verify_reports():
+    return verify.get_reports()
+
+
+@app.post("/api/video/clip")
+async def clip_video(req: clip.ClipReq):
+    if any(not path_regex.match(it) for it in req.file_names):
+        return JSONResponse({"code": -1, "msg": "Illegal file name"}, 400)
+    try:
+        if req.cid is not None and req.round is not None:
+            created = await asyncio.to_thread(clip.clip_round, req.cid, req.round, req.start, req.end, req.roles)
+        else:
+            created = await asyncio.to_thread(clip.clip_recordings, req.file_names, req.start, req.end)
+    except FileNotFoundError:
+        return JSONResponse({"code": 2, "msg": "M3U8 file not exist."}, 404)
+    except ValueError as e:
+        return JSONResponse({"code": -1, "msg": str(e)}, 400)
+    return {"code": 0, "data": created}
 
 
 @app.get("/api/video/delete/{file_name}")
@@ -159,24 +212,64 @@ async def delete_video(file_name: str = Path()):
 async def get_video_file(request: Request, file_name: str = Path()):
     if file_name.split('.')[-1] == 'mp4' and file_name in [it.name for it in config.mp4_dir.glob("*.mp4")]:
         return RangeResponse(request, str(config.mp4_dir / file_name), "video/mp4")
+    if file_name.split('.')[-1] == 'ts' and file_name in [it.name for it in config.mp4_dir.glob("*.ts")]:
+        return RangeResponse(request, str(config.mp4_dir / file_name), "video/MP2T")
     if not (path_regex.match(file_name) or path_f_regex.match(file_name)):
         return JSONResponse({"code": -1, "msg": "Illegal file name"}, 400)
     if not (config.save_dir / file_name).exists():
         return JSONResponse({"code": 2, "msg": "M3U8 file not exist."}, 404)
-    mime = "video/MP2T" if path_f_regex.match(file_name) else "application/x-mpegURL"
-    return RangeResponse(request, str(config.save_dir / file_name), mime)
+    if path_f_regex.match(file_name):
+        return RangeResponse(request, str(config.save_dir / file_name), "video/MP2T",
+                             "public, max-age=31536000, immutable")
+    return RangeResponse(request, str(config.save_dir / file_name), "application/x-mpegURL")
+
+
+@app.get("/api/hls/live/{role}")
+async def get_live_playlist(role: str, msn: int = Query(None, alias="_HLS_msn")):
+    downloader = manager.downloaders.get(role)
+    if downloader is None or downloader.task is None:
+        return JSONResponse({"code": 2, "msg": "Stream is not being recorded."}, 404)
+    if msn is not None:
+        await downloader.wait_segments(msn + 1, 3 * downloader.target_duration)
+    return Response(hls_gateway.render_live(downloader), media_type="application/x-mpegURL",
+                    headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/api/hls/{file_name}")
+async def get_hls_playlist(file_name: str = Path()):
+    if not path_regex.match(file_name):
+        return JSONResponse({"code": -1, "msg": "Illegal file name"}, 400)
+    try:
+        text, live = hls_gateway.render(file_name)
+    except FileNotFoundError:
+        return JSONResponse({"code": 2, "msg": "M3U8 file not exist."}, 404)
+    return Response(text, media_type="application/x-mpegURL", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/api/hls/s/{prefix}/{expires}/{signature}/{segment}")
+async def get_hls_segment(request: Request, prefix: str, expires: int, signature: str, segment: str):
+    if not (path_f_regex.match(segment) and segment.startswith(f"{prefix}_") and
+            hls_gateway.verify(prefix, expires, signature)):
+        return JSONResponse({"code": -1, "msg": "Invalid token"}, 403)
+    try:
+        return RangeResponse(request, str(config.save_dir / segment), "video/MP2T",
+                             "public, max-age=31536000, immutable")
+    except FileNotFoundError:
+        return JSONResponse({"code": 2, "msg": "Segment not exist."}, 404)
 
 
 @app.get("/api/video/download/{file_name}")
-async def download_video(request: Request, file_name: str = Path()):
+async def download_video(request: Request, file_name: str = Path(), format: str = "mp4"):
     if not path_regex.match(file_name):
         return JSONResponse({"code": -1, "msg": "Illegal file name"}, 400)
+    if format not in ("mp4", "ts"):
+        return JSONResponse({"code": -1, "msg": "Illegal format"}, 400)
     if not (config.save_dir / file_name).exists():
         return JSONResponse({"code": 2, "msg": "M3U8 file not exist."}, 404)
-    mp4 = config.mp4_dir / f"{get_video_info(file_name).title}.mp4"
-    if not mp4.exists():
-        return JSONResponse({"code": 1, "msg": "MP4 file not created"}, 404)
-    return RangeResponse(request, str(mp4), "video/mp4")
+    output = transcode.output_path(get_video_info(file_name).title, format)
+    if not output.exists():
+        return JSONResponse({"code": 1, "msg": f"{format.upper()} file not created"}, 404)
+    return RangeResponse(request, str(output), "video/mp4" if format == "mp4" else "video/MP2T")
 
 
 @app.get("/api/bili/login")
@@ -203,8 +296,34 @@ async def get_bili_username():
 
 @app.post("/api/bili/upload")
 async def upload_bili(title: str, videos: List[str]):
-    upload_video(title, [get_video_info(video).title for video in videos])
-    return JSONResponse({"code": 0}, 200)
+    if any(not path_regex.match(it) for it in videos):
+        return JSONResponse({"code": -1, "msg": "Illegal file name"}, 400)
+    try:
+        job = await upload_video(title, [get_video_info(video).title for video in videos])
+    except FileNotFoundError:
+        return JSONResponse({"code": 1, "msg": "MP4 file not created"}, 404)
+    return JSONResponse({"code": 0, "job": job.dict()}, 200)
+
+
+@app.get("/api/bili/upload/jobs")
+async def get_upload_jobs():
+    return upload.jobs.get_jobs()
+
+
+@app.get("/api/bili/upload/jobs/{job_id}")
+async def get_upload_job(job_id: int):
+    job = upload.jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"code": 2, "msg": "Job not exist."}, 404)
+    return job
+
+
+@app.get("/api/bili/upload/retry/{job_id}")
+async def retry_upload_job(job_id: int):
+    job = await upload.jobs.retry(job_id)
+    if job is None:
+        return JSONResponse({"code": 2, "msg": "No failed job with this id."}, 404)
+    return {"code": 0, "job": job.dict()}
 
 
 if __name__ == '__main__':
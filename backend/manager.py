@@ -1,10 +1,11 @@
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Coroutine
+from collections import deque
+import time
 import json
 import asyncio
 import traceback
 from datetime import datetime
 
-import aiohttp
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.job import Job
 from pydantic import BaseModel
@@ -12,6 +13,7 @@ from asyncache import cached
 from cachetools import TTLCache
 
 import config
+import http_pool
 from downloader import Downloader, RoundInfo
 from logger import getLogger
 
@@ -32,44 +34,64 @@ class DownloaderInfo(BaseModel):
     error_count: int
     quality: str = "None"
     recorded: float = 0
+    skipped: int = 0
+    polls: int = 0
+    latency: float = 0
+    queue_depth: int = 0
+    write_speed: float = 0
+
+
+class TransitionInfo(BaseModel):
+    action: str
+    title: str
+    count: int
+    latency: float
+    timeout: int = 0
+    time: float
 
 
 class ManagerInfo(BaseModel):
     round_info: RoundInfo
     manual_mode: bool
     downloaders: List[DownloaderInfo]
+    transitions: List[TransitionInfo] = []
+
+
+def parse_round_info(body: bytes) -> RoundInfo:
+    _data = json.loads(body)
+    info = RoundInfo(red="Null", blue="Null", round=0, id=0, status="IDLE")
+    for data in _data:
+        data = data['currentMatch']
+        if data is None:
+            continue
+        round = data['round']
+        if round is None:
+            round = 0
+        if data['redSide']['player'] is None:
+            info = RoundInfo(**{
+                "red": data['redSideId'],
+                "blue": data['blueSideId'],
+                "round": round,
+                "id": data['id'],
+                "status": data['status']
+            })
+            break
+        info = RoundInfo(**{
+            "red": data['redSide']['player']['team']['collegeName'],
+            "blue": data['blueSide']['player']['team']['collegeName'],
+            "round": round,
+            "id": data['id'],
+            "status": data['status']
+        })
+        break
+    return info
+
+
+round_info_resource = http_pool.CachedResource("oss", config.round_info_url, parse_round_info)
 
 
 async def get_round_info() -> RoundInfo:
-    async with aiohttp.ClientSession(headers=config.oss_headers, timeout=aiohttp.ClientTimeout(total=10)) as session:
-        async with session.get(config.round_info_url) as response:
-            _data = await response.json()
-            info = RoundInfo(red="Null", blue="Null", round=0, id=0, status="IDLE")
-            for data in _data:
-                data = data['currentMatch']
-                if data is None:
-                    continue
-                round = data['round']
-                if round is None:
-                    round = 0
-                if data['redSide']['player'] is None:
-                    info = RoundInfo(**{
-                        "red": data['redSideId'],
-                        "blue": data['blueSideId'],
-                        "round": round,
-                        "id": data['id'],
-                        "status": data['status']
-                    })
-                    break
-                info = RoundInfo(**{
-                    "red": data['redSide']['player']['team']['collegeName'],
-                    "blue": data['blueSide']['player']['team']['collegeName'],
-                    "round": round,
-                    "id": data['id'],
-                    "status": data['status']
-                })
-                break
-            return info
+    return (await round_info_resource.get()).copy()
 
 
 def live_string_to_dict(live_string: List) -> Dict[str, str]:
@@ -103,41 +125,47 @@ def check_date_position(dates: List[str]) -> int:
         return 0
 
 
+def parse_live_info(body: dict) -> LiveInfo:
+    default_event_index = 0
+    data = body['eventData']
+    info = {
+        "live": False,
+        "streams": {}
+    }
+    zoneName = 'Not Got'
+    ok = False
+    for live_info in data:
+        if live_info['liveState'] != 1 or live_info['matchState'] != 1:
+            continue
+        ok = True
+        info['live'] = True
+        zoneName = live_info['zoneName']
+        convert_live_info(live_info, info)
+    if not ok:
+        live_info = data[default_event_index]
+        min_date_diff = 99999
+        for _live_info in data:
+            date_diff = check_date_position(_live_info['zoneDate'])
+            if date_diff == 0:
+                break
+            if date_diff == -1:
+                continue
+            if date_diff < min_date_diff:
+                min_date_diff = date_diff
+                live_info = _live_info
+        convert_live_info(live_info, info)
+        zoneName = live_info['zoneName']
+    print(f"Got {zoneName} Live Info")
+    return LiveInfo(**info)
+
+
+# only the decoded JSON is cached: without a live event the stream pick depends on today's date
+live_info_resource = http_pool.CachedResource("oss", config.live_info_url, json.loads)
+
+
 @cached(TTLCache(1, 5))
 async def get_live_info() -> LiveInfo:
-    default_event_index = 0
-    async with aiohttp.ClientSession(headers=config.oss_headers, timeout=aiohttp.ClientTimeout(total=10)) as session:
-        async with session.get(config.live_info_url) as response:
-            data = json.loads(await response.text())['eventData']
-            info = {
-                "live": False,
-                "streams": {}
-            }
-            zoneName = 'Not Got'
-            ok = False
-            for live_info in data:
-                if live_info['liveState'] != 1 or live_info['matchState'] != 1:
-                    continue
-                ok = True
-                info['live'] = True
-                zoneName = live_info['zoneName']
-                convert_live_info(live_info, info)
-            if not ok:
-                live_info = data[default_event_index]
-                min_date_diff = 99999
-                for _live_info in data:
-                    date_diff = check_date_position(_live_info['zoneDate'])
-                    if date_diff == 0:
-                        break
-                    if date_diff == -1:
-                        continue
-                    if date_diff < min_date_diff:
-                        min_date_diff = date_diff
-                        live_info = _live_info
-                convert_live_info(live_info, info)
-                zoneName = live_info['zoneName']
-            print(f"Got {zoneName} Live Info")
-            return LiveInfo(**info)
+    return parse_live_info(await live_info_resource.get())
 
 
 class Manager:
@@ -155,6 +183,7 @@ class Manager:
         self.job: Union[Job, None] = None
         self.logger = getLogger("Manager", "INFO")
         self.manual_mode = False
+        self.transitions: deque[TransitionInfo] = deque(maxlen=20)
 
     async def init(self):
         self.scheduler.start()
@@ -164,7 +193,7 @@ class Manager:
             if stream is None:
                 self.downloaders[req.role] = None
             else:
-                self.downloaders[req.role] = Downloader(req.role, stream, self.scheduler)
+                self.downloaders[req.role] = Downloader(req.role, stream)
                 self.logger.info(f"Add {req.role} to downloaders")
         self.job = self.scheduler.add_job(self.scan, "interval", seconds=10)
         await self.scan()
@@ -176,17 +205,44 @@ class Manager:
             traceback.print_exc()
             self.logger.error(f"Error: {e}")
 
+    async def _fan_out(self, action: str, title: str, coros: List[Coroutine]):
+        if not coros:
+            return
+        begin = time.perf_counter()
+        tasks = [asyncio.create_task(coro) for coro in coros]
+        done, pending = await asyncio.wait(tasks, timeout=config.transition_timeout)
+        for task in done:
+            if task.exception() is not None:
+                self.logger.error(f"{action} failed: {task.exception()}")
+        if pending:
+            self.logger.warning(f"{len(pending)} downloaders missed the {action} deadline")
+        latency = time.perf_counter() - begin
+        self.transitions.append(TransitionInfo(
+            action=action, title=title, count=len(tasks), latency=round(latency, 3),
+            timeout=len(pending), time=time.time()
+        ))
+        self.logger.info(f"{action} {len(tasks)} downloaders in {latency * 1000:.0f}ms")
+
+    async def _start_all(self, info: RoundInfo, only_idle: bool = False):
+        downloaders = [it for it in self.downloaders.values()
+                       if it is not None and (not only_idle or it.cid == -1)]
+        await self._fan_out("start", f"{info.red} Vs {info.blue} R{info.round}", [
+            downloader.start(info, delay=i * config.start_stagger) for i, downloader in enumerate(downloaders)
+        ])
+
+    async def _end_all(self):
+        title = "Null" if self.round is None else f"{self.round.red} Vs {self.round.blue} R{self.round.round}"
+        await self._fan_out("end", title, [
+            downloader.end() for downloader in self.downloaders.values() if downloader is not None
+        ])
+
     async def manual_start(self):
         _round = RoundInfo(red="红方", blue="蓝方", round=1, id=99999, status="STARTED")
         self.manual_mode = True
-        for downloader in self.downloaders.values():
-            if downloader is not None and downloader.cid == -1:
-                await downloader.start(_round)
+        await self._start_all(_round, only_idle=True)
 
     async def manual_end(self):
-        for downloader in self.downloaders.values():
-            if downloader is not None:
-                await downloader.end()
+        await self._end_all()
         self.manual_mode = False
 
     async def _scan(self):
@@ -197,16 +253,14 @@ class Manager:
             stream = live_info.streams.get(req.role, {}).get(req.quality)
             if stream is not None:
                 if self.downloaders.get(req.role) is None:
-                    self.downloaders[req.role] = Downloader(req.role, stream, self.scheduler)
+                    self.downloaders[req.role] = Downloader(req.role, stream)
                 else:
                     self.downloaders[req.role].url = stream
 
         if not self.manual_mode:
             if not (live_info.live or round_.status != 'IDLE'):
                 if self.status == 'STARTED':
-                    for downloader in self.downloaders.values():
-                        if downloader is not None:
-                            await downloader.end()
+                    await self._end_all()
                     self.status = "IDLE"
                     self.round = await get_round_info()
                 self.job.reschedule(trigger="interval", seconds=120)
@@ -218,26 +272,19 @@ class Manager:
             if self.round is None or round_ != self.round:
                 self.round = round_
                 if self.round.status == 'STARTED':
-                    for downloader in self.downloaders.values():
-                        if downloader is not None:
-                            await downloader.start(self.round)
-                            await asyncio.sleep(0.5)
+                    await self._start_all(self.round)
                     self.status = "STARTED"
                 else:
-                    for downloader in self.downloaders.values():
-                        if downloader is not None:
-                            await downloader.end()
+                    await self._end_all()
                     self.status = "IDLE"
             else:
                 if self.round.status == 'STARTED':
-                    for downloader in self.downloaders.values():
-                        if downloader is not None and downloader.cid == -1:
-                            await downloader.start(self.round)
+                    await self._start_all(self.round, only_idle=True)
 
     async def close(self):
-        for downloader in self.downloaders.values():
-            if downloader is not None:
-                await downloader.close()
+        await self._fan_out("close", "Null", [
+            downloader.close() for downloader in self.downloaders.values() if downloader is not None
+        ])
         self.scheduler.shutdown()
         self.logger.info("Manager closed")
 
@@ -260,12 +307,18 @@ class Manager:
                                                  len(downloader.segments) > 0)),
                     error_count=downloader.error_count,
                     quality=self.get_req(role).quality,
-                    recorded=round(sum([it.duration for it in downloader.segments]))
+                    recorded=round(downloader.metrics.recorded),
+                    skipped=downloader.metrics.skipped,
+                    polls=downloader.metrics.polls,
+                    latency=round(downloader.metrics.latency, 2),
+                    queue_depth=downloader.storage.stats.queue_depth,
+                    write_speed=round(downloader.storage.stats.throughput / 1024 / 1024, 2)
                 ))
         _round = self.round
         if _round is None:
             _round = RoundInfo(red="Null", blue="Null", round=0, id=0, status="IDLE")
-        return ManagerInfo(round_info=_round, manual_mode=self.manual_mode, downloaders=downloaders)
+        return ManagerInfo(round_info=_round, manual_mode=self.manual_mode, downloaders=downloaders,
+                           transitions=list(self.transitions))
 
     def _save_reqs(self):
         reqs = [it.dict() for it in self.reqs]
@@ -311,5 +364,6 @@ if __name__ == '__main__':
         await manager.init()
         await asyncio.sleep(3600 * 2)
         await manager.close()
+        await http_pool.close()
 
     asyncio.run(main())
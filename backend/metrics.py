@@ -0,0 +1,155 @@
+import math
+import time
+import bisect
+from typing import List, Tuple
+
+import config
+from storage import StorageStats
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "recorder_"
+
+
+class Histogram:
+    """Fixed bucket histogram, ``observe`` costs one bisect over the bucket bounds"""
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        res = []
+        total = 0
+        for bound, count in zip(self.buckets + [math.inf], self.counts):
+            total += count
+            res.append(("+Inf" if bound == math.inf else f"{bound:g}", total))
+        return res
+
+
+class RateMeter:
+    """Exponentially decaying per second rate over roughly ``window`` seconds"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.value = 0.
+        self.last = time.monotonic()
+
+    def _decay(self, now: float):
+        self.value *= math.exp((self.last - now) / self.window)
+        self.last = now
+
+    def add(self, amount: float):
+        self._decay(time.monotonic())
+        self.value += amount
+
+    def rate(self) -> float:
+        self._decay(time.monotonic())
+        return self.value / self.window
+
+
+class StreamMetrics:
+    """Health counters of one stream, updated by its Downloader as segments arrive.
+
+    Everything is kept incrementally so reading them for ``/api/manager`` or a Prometheus scrape costs
+    the same no matter how long the recording is.
+    """
+
+    def __init__(self, stream: str, storage: StorageStats):
+        self.stream = stream
+        self.storage = storage
+        self.recording = False
+        self.segments = 0
+        self.bytes = 0
+        self.recorded = 0.
+        self.polls = 0
+        self.skipped = 0
+        self.gaps = 0
+        self.errors = 0
+        self.latency = 0.
+        self.last_sequence = -1
+        self.last_segment = time.time()
+        self.segment_rate = RateMeter(config.metrics_rate_window)
+        self.byte_rate = RateMeter(config.metrics_rate_window)
+        self.poll_latency = Histogram(config.metrics_latency_buckets)
+        self.fetch_latency = Histogram(config.metrics_latency_buckets)
+        self.write_latency = Histogram(config.metrics_write_buckets)
+
+    def start(self):
+        """A new recording begins, it is stale only once no segment arrived for a while"""
+        self.recording = True
+        self.recorded = 0.
+        self.last_sequence = -1
+        self.last_segment = time.time()
+
+    def add_segments(self, sequences: List[int], duration: float, size: int):
+        """Account segments appended to the recording, ``sequences`` in ascending order"""
+        for it in sequences:
+            if self.last_sequence != -1 and it != self.last_sequence + 1:
+                self.gaps += 1
+            self.last_sequence = it
+        self.segments += len(sequences)
+        self.bytes += size
+        self.recorded += duration
+        self.last_segment = time.time()
+        self.segment_rate.add(len(sequences))
+        self.byte_rate.add(size)
+
+    @property
+    def staleness(self) -> float:
+        """Seconds since the last new segment while recording"""
+        return time.time() - self.last_segment if self.recording else 0.
+
+
+_counters = [
+    ("segments_total", "counter", "Segments downloaded", lambda it: it.segments),
+    ("bytes_total", "counter", "Segment bytes downloaded", lambda it: it.bytes),
+    ("polls_total", "counter", "Playlist requests", lambda it: it.polls),
+    ("skipped_total", "counter", "Playlist entries skipped as already downloaded", lambda it: it.skipped),
+    ("gaps_total", "counter", "Jumps in segment sequence numbers", lambda it: it.gaps),
+    ("errors_total", "counter", "Failed playlist and segment requests", lambda it: it.errors),
+    ("recording", "gauge", "1 while the stream is being captured", lambda it: int(it.recording)),
+    ("recorded_seconds", "gauge", "Media duration of the current recording", lambda it: round(it.recorded, 3)),
+    ("segments_per_second", "gauge", "Recent segment download rate", lambda it: round(it.segment_rate.rate(), 4)),
+    ("bytes_per_second", "gauge", "Recent download throughput", lambda it: round(it.byte_rate.rate(), 1)),
+    ("playlist_staleness_seconds", "gauge", "Seconds since the last new segment", lambda it: round(it.staleness, 3)),
+    ("live_latency_seconds", "gauge", "Delay behind the live edge", lambda it: round(it.latency, 3)),
+    ("storage_queue_depth", "gauge", "Writes waiting for the storage pool", lambda it: it.storage.queue_depth),
+]
+
+_histograms = [
+    ("poll_latency_seconds", "Playlist request latency", lambda it: it.poll_latency),
+    ("fetch_latency_seconds", "Segment download latency", lambda it: it.fetch_latency),
+    ("write_latency_seconds", "Storage batch write latency", lambda it: it.write_latency),
+]
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(streams: List[StreamMetrics]) -> str:
+    """Prometheus text exposition of every stream"""
+    lines = []
+    for name, kind, description, get in _counters:
+        lines.append(f"# HELP {PREFIX}{name} {description}")
+        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+        for it in streams:
+            lines.append(f'{PREFIX}{name}{{stream="{_label(it.stream)}"}} {get(it)}')
+    for name, description, get in _histograms:
+        lines.append(f"# HELP {PREFIX}{name} {description}")
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        for it in streams:
+            histogram = get(it)
+            label = _label(it.stream)
+            for bound, count in histogram.cumulative():
+                lines.append(f'{PREFIX}{name}_bucket{{stream="{label}",le="{bound}"}} {count}')
+            lines.append(f'{PREFIX}{name}_sum{{stream="{label}"}} {round(histogram.sum, 6)}')
+            lines.append(f'{PREFIX}{name}_count{{stream="{label}"}} {histogram.count}')
+    return "\n".join(lines) + "\n"
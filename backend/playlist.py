@@ -0,0 +1,107 @@
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+from logger import getLogger
+
+logger = getLogger("Playlist", "INFO")
+
+TRAILER = b"#EXT-X-ENDLIST\n"
+open_playlists = set()
+
+
+class PlaylistWriter:
+    """Append-only m3u8 writer.
+
+    The file always ends with ``#EXT-X-ENDLIST`` so a recording in progress stays playable;
+    each append overwrites the trailer with the new entries and writes it again.
+    """
+
+    def __init__(self, path: Path, title: str):
+        self.path = path
+        self.title = title
+        self.last_id = -1
+        self.count = 0
+        self.body_end = 0
+        self.file = None
+
+    def _create(self):
+        header = (
+            "#EXTM3U\n"
+            "#EXT-X-TARGETDURATION:4\n"
+            "#EXT-X-PLAYLIST-TYPE:VOD\n"
+            f"#TITLE:{self.title}\n"
+        ).encode("utf-8")
+        tmp = self.path.with_suffix(".m3u8.tmp")
+        with open(tmp, "wb") as f:
+            f.write(header + TRAILER)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.body_end = len(header)
+        self.file = open(self.path, "r+b")
+        open_playlists.add(self.path.name)
+
+    def append(self, entries: List[Tuple[int, float, str]]):
+        """Append ``(sequence, duration, file_name)`` entries, marking gaps in sequence numbers"""
+        if not entries:
+            return
+        if self.file is None:
+            self._create()
+        lines = []
+        for id_, duration, file_name in entries:
+            if id_ != self.last_id + 1 and self.last_id != -1:
+                lines.append("#EXT-X-DISCONTINUITY\n")
+            lines.append(f"#EXTINF:{duration},\n")
+            lines.append(f"{file_name}\n")
+            self.last_id = id_
+        block = "".join(lines).encode("utf-8")
+        self.file.seek(self.body_end)
+        self.file.write(block + TRAILER)
+        self.file.truncate()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.body_end += len(block)
+        self.count += len(entries)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            open_playlists.discard(self.path.name)
+
+
+def repair(path: Path) -> bool:
+    """Drop a torn tail left by an interrupted append and restore the trailer"""
+    with open(path, "r+b") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 4096))
+        if f.read().endswith(TRAILER):
+            return False
+        f.seek(0)
+        lines = f.read().splitlines(keepends=True)
+        keep = 0
+        offset = 0
+        for i, line in enumerate(lines):
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            if not line.startswith(b"#") and i > 0 and lines[i - 1].startswith(b"#EXTINF"):
+                keep = offset
+            elif line.startswith(b"#") and not line.startswith((b"#EXTINF", b"#EXT-X-DISCONTINUITY",
+                                                                  b"#EXT-X-ENDLIST")):
+                keep = max(keep, offset)
+        f.seek(keep)
+        f.write(TRAILER)
+        f.truncate()
+    logger.warning(f"Repaired torn playlist {path.name}")
+    return True
+
+
+def repair_all(directory: Path):
+    for it in directory.glob("*.m3u8"):
+        try:
+            repair(it)
+        except OSError as e:
+            logger.error(f"Cannot repair {it.name}: {e}")
@@ -1,74 +1,162 @@
 import os
-from typing import BinaryIO
+import secrets
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Tuple
 
+import anyio
 from fastapi import HTTPException, Request, status
-from fastapi.responses import StreamingResponse
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
 
+CHUNK_SIZE = 256 * 1024
+MAX_RANGES = 16
 
-def send_bytes_range_requests(
-    file_obj: BinaryIO, start: int, end: int, chunk_size: int = 10_000
-):
-    """Send a file in chunks using Range Requests specification RFC7233
-
-    `start` and `end` parameters are inclusive due to specification
-    """
-    with file_obj as f:
-        f.seek(start)
-        while (pos := f.tell()) <= end:
-            read_size = min(chunk_size, end + 1 - pos)
-            yield f.read(read_size)
 
+def _get_range_header(range_header: str, file_size: int) -> List[Tuple[int, int]]:
+    """Parse ``bytes=`` ranges (including suffix ranges) into sorted, merged inclusive ``(start, end)`` pairs.
 
-def _get_range_header(range_header: str, file_size: int) -> tuple[int, int]:
+    Overlapping and adjacent ranges are coalesced, so a header repeating ``0-`` cannot multiply the
+    response. An empty list means the header asks for more than ``MAX_RANGES`` parts and is ignored.
+    """
     def _invalid_range():
         return HTTPException(
             status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
             detail=f"Invalid request range (Range:{range_header!r})",
+            headers={"content-range": f"bytes */{file_size}"},
         )
 
+    if not range_header.startswith("bytes="):
+        raise _invalid_range()
+    items = range_header[6:].split(",")
+    if len(items) > MAX_RANGES:
+        return []
+    ranges = []
     try:
-        h = range_header.replace("bytes=", "").split("-")
-        start = int(h[0]) if h[0] != "" else 0
-        end = int(h[1]) if h[1] != "" else file_size - 1
+        for item in items:
+            h = item.strip().split("-")
+            if len(h) != 2:
+                raise ValueError
+            if h[0] == "":
+                start = max(0, file_size - int(h[1]))
+                end = file_size - 1
+            else:
+                start = int(h[0])
+                end = min(int(h[1]), file_size - 1) if h[1] != "" else file_size - 1
+            if start > end or start < 0 or start >= file_size:
+                raise ValueError
+            ranges.append((start, end))
     except ValueError:
         raise _invalid_range()
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
-    if start > end or start < 0 or end > file_size - 1:
-        raise _invalid_range()
-    return start, end
-
-
-def RangeResponse(
-    request: Request, file_path: str, content_type: str = 'audio/mpeg'
-):
-    """Returns StreamingResponse using Range Requests of a given file"""
-
-    file_size = os.stat(file_path).st_size
-    range_header = request.headers.get("range")
-
-    headers = {
-        "content-type": content_type,
-        "accept-ranges": "bytes",
-        "content-encoding": "identity",
-        "content-length": str(file_size),
-        "access-control-expose-headers": (
-            "content-type, accept-ranges, content-length, "
-            "content-range, content-encoding"
-        ),
-    }
-    start = 0
-    end = file_size - 1
-    status_code = status.HTTP_200_OK
-
-    if range_header is not None:
-        start, end = _get_range_header(range_header, file_size)
-        size = end - start + 1
-        headers["content-length"] = str(size)
-        headers["content-range"] = f"bytes {start}-{end}/{file_size}"
-        status_code = status.HTTP_206_PARTIAL_CONTENT
-
-    return StreamingResponse(
-        send_bytes_range_requests(open(file_path, mode="rb"), start, end),
-        headers=headers,
-        status_code=status_code,
-    )
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [it.strip() for it in if_none_match.split(",")]
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _if_range_matches(request: Request, etag: str, last_modified: str) -> bool:
+    if_range = request.headers.get("if-range")
+    return if_range is None or if_range == etag or if_range == last_modified
+
+
+class RangeResponse(Response):
+    """File response with validators and single/multi Range requests, read in large chunks off the event loop"""
+
+    def __init__(self, request: Request, file_path: str, content_type: str = 'audio/mpeg',
+                 cache_control: str = "no-cache"):
+        stat = os.stat(file_path)
+        self.file_path = file_path
+        self.file_size = stat.st_size
+        self.ranges: List[Tuple[int, int]] = []
+        self.parts: List[Tuple[bytes, int, int]] = []
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "last-modified": last_modified,
+            "cache-control": cache_control,
+            "access-control-expose-headers": (
+                "content-type, accept-ranges, content-length, "
+                "content-range, content-encoding, etag, last-modified"
+            ),
+        }
+        status_code = status.HTTP_200_OK
+        range_header = request.headers.get("range")
+
+        if _not_modified(request, etag, stat.st_mtime):
+            status_code = status.HTTP_304_NOT_MODIFIED
+        elif range_header is not None and _if_range_matches(request, etag, last_modified):
+            self.ranges = _get_range_header(range_header, self.file_size)
+            if self.ranges:
+                status_code = status.HTTP_206_PARTIAL_CONTENT
+
+        if status_code == status.HTTP_304_NOT_MODIFIED:
+            length = 0
+        elif len(self.ranges) == 1:
+            start, end = self.ranges[0]
+            headers["content-type"] = content_type
+            headers["content-range"] = f"bytes {start}-{end}/{self.file_size}"
+            length = end - start + 1
+        elif len(self.ranges) > 1:
+            boundary = secrets.token_hex(16)
+            headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+            length = 0
+            for start, end in self.ranges:
+                head = (f"--{boundary}\r\ncontent-type: {content_type}\r\n"
+                        f"content-range: bytes {start}-{end}/{self.file_size}\r\n\r\n").encode()
+                self.parts.append((head, start, end))
+                length += len(head) + end - start + 1 + 2
+            self.parts.append((f"--{boundary}--\r\n".encode(), 0, -1))
+            length += len(self.parts[-1][0])
+        else:
+            headers["content-type"] = content_type
+            self.ranges = [(0, self.file_size - 1)]
+            length = self.file_size
+        if status_code != status.HTTP_304_NOT_MODIFIED:
+            headers["content-encoding"] = "identity"
+            headers["content-length"] = str(length)
+
+        super().__init__(status_code=status_code, headers=headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.status_code == status.HTTP_304_NOT_MODIFIED:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        async with await anyio.open_file(self.file_path, "rb") as f:
+            if self.parts:
+                for head, start, end in self.parts:
+                    await send({"type": "http.response.body", "body": head, "more_body": True})
+                    if end >= start:
+                        await self._send_range(send, f, start, end)
+                        await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+            else:
+                start, end = self.ranges[0]
+                await self._send_range(send, f, start, end)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    @staticmethod
+    async def _send_range(send: Send, f: anyio.AsyncFile, start: int, end: int):
+        pos = await f.seek(start)
+        while pos <= end:
+            data = await f.read(min(CHUNK_SIZE, end + 1 - pos))
+            if not data:
+                break
+            pos += len(data)
+            await send({"type": "http.response.body", "body": data, "more_body": True})
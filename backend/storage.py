@@ -0,0 +1,179 @@
+import os
+import time
+import asyncio
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable, List, Union
+
+from pydantic import BaseModel
+
+import config
+from logger import getLogger
+
+logger = getLogger("Storage", "INFO")
+executor = ThreadPoolExecutor(max_workers=config.storage_workers, thread_name_prefix="storage")
+
+
+class StorageStats(BaseModel):
+    queue_depth: int = 0
+    files: int = 0
+    bytes: int = 0
+    write_time: float = 0
+
+    @property
+    def throughput(self) -> float:
+        if self.write_time == 0:
+            return 0
+        return self.bytes / self.write_time
+
+
+class _Op:
+    def __init__(self, fn: Callable, args: tuple, size: int = 0, future: Union[asyncio.Future, None] = None):
+        self.fn = fn
+        self.args = args
+        self.size = size
+        self.future = future
+        self.result: Any = None
+        self.error: Union[BaseException, None] = None
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args)
+        except Exception as e:
+            self.error = e
+
+
+class SegmentFile:
+    """A file written under a ``.part`` name and renamed into place once complete"""
+
+    def __init__(self, storage: "SegmentStorage", path: Path):
+        self.storage = storage
+        self.path = path
+        self.tmp_path = path.with_name(path.name + ".part")
+        self.fp: Union[BinaryIO, None] = None
+        self.error: Union[OSError, None] = None
+        self.size = 0
+
+    def _open(self):
+        try:
+            self.fp = open(self.tmp_path, "wb")
+        except OSError as e:
+            self.error = e
+
+    def _write(self, data: bytes):
+        if self.error is not None:
+            return
+        try:
+            self.fp.write(data)
+        except OSError as e:
+            self.error = e
+
+    def _close(self):
+        if self.fp is None:
+            return
+        try:
+            self.fp.flush()
+            if config.storage_fsync == "segment" and self.error is None:
+                os.fsync(self.fp.fileno())
+        except OSError as e:
+            self.error = e
+        finally:
+            self.fp.close()
+            self.fp = None
+
+    def _commit(self):
+        self._close()
+        if self.error is None:
+            try:
+                os.replace(self.tmp_path, self.path)
+            except OSError as e:
+                self.error = e
+
+    def _discard(self):
+        self._close()
+        self.tmp_path.unlink(missing_ok=True)
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        await self.storage.put(_Op(self._write, (data,), size=len(data)))
+
+    async def close(self):
+        """Wait until every queued chunk of this file is on disk and renamed into place"""
+        await self.storage.call(self._commit)
+        if self.error is not None:
+            raise self.error
+        self.storage.stats.files += 1
+
+    async def abort(self):
+        await asyncio.shield(self.storage.call(self._discard))
+
+
+class SegmentStorage:
+    """Per-stream write-behind queue drained in order by the shared storage thread pool"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queue: asyncio.Queue[_Op] = asyncio.Queue(maxsize=config.storage_queue_size)
+        self.stats = StorageStats()
+        self.worker: Union[asyncio.Task, None] = None
+        self.on_write: Union[Callable[[float], None], None] = None
+
+    async def put(self, op: _Op):
+        if self.worker is None:
+            self.worker = asyncio.create_task(self._drain(), name=f"Storage-{self.name}")
+        await self.queue.put(op)
+
+    async def call(self, fn: Callable, *args) -> Any:
+        """Run ``fn`` on the storage thread after everything queued before it"""
+        future = asyncio.get_running_loop().create_future()
+        await self.put(_Op(fn, args, future=future))
+        return await future
+
+    async def open(self, path: Path) -> SegmentFile:
+        file = SegmentFile(self, path)
+        await self.put(_Op(file._open, ()))
+        return file
+
+    @staticmethod
+    def _run(ops: List[_Op]):
+        for op in ops:
+            op.run()
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            ops = [await self.queue.get()]
+            while not self.queue.empty():
+                ops.append(self.queue.get_nowait())
+            self.stats.queue_depth = len(ops)
+            begin = time.perf_counter()
+            await asyncio.shield(loop.run_in_executor(executor, self._run, ops))
+            elapsed = time.perf_counter() - begin
+            self.stats.write_time += elapsed
+            if self.on_write is not None:
+                self.on_write(elapsed)
+            for op in ops:
+                self.stats.bytes += op.size
+                if op.future is not None and not op.future.done():
+                    if op.error is not None:
+                        op.future.set_exception(op.error)
+                    else:
+                        op.future.set_result(op.result)
+                elif op.error is not None:
+                    logger.error(f"Storage error on {self.name}: {op.error}")
+                self.queue.task_done()
+            self.stats.queue_depth = self.queue.qsize()
+
+    async def close(self):
+        if self.worker is not None:
+            await self.queue.join()
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+            self.worker = None
+
+
+def remove_partial(directory: Path):
+    """Delete segment files left unfinished by a previous run"""
+    for it in directory.glob("*.part"):
+        it.unlink(missing_ok=True)
+        logger.warning(f"Removed partial file {it.name}")
@@ -0,0 +1,321 @@
+import os
+import sys
+import time
+import asyncio
+import subprocess
+import sqlite3
+from collections import deque
+from typing import Deque, Dict, List, Tuple, Union
+
+from pydantic import BaseModel
+
+import config
+import catalog
+import ts_concat
+from logger import getLogger
+
+logger = getLogger("Transcode", "INFO")
+
+FIELDS = ["id", "file_name", "title", "format", "auto", "status", "duration", "out_time", "progress", "bytes", "error",
+          "created", "started", "finished"]
+
+
+def _create_table(db: sqlite3.Connection):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS transcode_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_name TEXT NOT NULL,
+            title TEXT NOT NULL,
+            format TEXT NOT NULL DEFAULT 'mp4',
+            auto INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            duration REAL NOT NULL DEFAULT 0,
+            out_time REAL NOT NULL DEFAULT 0,
+            progress REAL NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            error TEXT NOT NULL DEFAULT '',
+            created REAL NOT NULL DEFAULT 0,
+            started REAL NOT NULL DEFAULT 0,
+            finished REAL NOT NULL DEFAULT 0
+        )
+    """)
+    columns = [it["name"] for it in db.execute("PRAGMA table_info(transcode_jobs)")]
+    for column, definition in (("format", "TEXT NOT NULL DEFAULT 'mp4'"), ("auto", "INTEGER NOT NULL DEFAULT 0")):
+        if column not in columns:
+            db.execute(f"ALTER TABLE transcode_jobs ADD COLUMN {column} {definition}")
+    db.execute("CREATE INDEX IF NOT EXISTS transcode_jobs_status ON transcode_jobs (status, id)")
+
+
+catalog.register_table(_create_table)
+
+
+class TranscodeJob(BaseModel):
+    id: int = 0
+    file_name: str
+    title: str
+    format: str = "mp4"
+    auto: bool = False
+    status: str = "queued"
+    duration: float = 0
+    out_time: float = 0
+    progress: float = 0
+    bytes: int = 0
+    speed: float = 0
+    error: str = ""
+    created: float = 0
+    started: float = 0
+    finished: float = 0
+
+
+class TranscodeStats(BaseModel):
+    workers: int
+    queued: int
+    running: int
+    done: int
+    failed: int
+    bytes: int
+    media_seconds: float
+    busy_seconds: float
+    throughput: float
+    speed: float
+
+
+def _save(job: TranscodeJob):
+    values = job.dict()
+    with catalog.transaction() as db:
+        if job.id == 0:
+            cursor = db.execute(
+                f"INSERT INTO transcode_jobs ({', '.join(FIELDS[1:])}) VALUES ({', '.join('?' * (len(FIELDS) - 1))})",
+                [values[it] for it in FIELDS[1:]]
+            )
+            job.id = cursor.lastrowid
+        else:
+            db.execute(
+                f"UPDATE transcode_jobs SET {', '.join(f'{it} = ?' for it in FIELDS[1:])} WHERE id = ?",
+                [values[it] for it in FIELDS[1:]] + [job.id]
+            )
+
+
+def _load(where: str, params: tuple = ()) -> List[TranscodeJob]:
+    with catalog.transaction() as db:
+        rows = db.execute(f"SELECT * FROM transcode_jobs WHERE {where}", params).fetchall()
+    return [TranscodeJob(**dict(it)) for it in rows]
+
+
+def output_path(title: str, format: str = "mp4"):
+    return config.mp4_dir / f"{title}.{format}"
+
+
+def _low_priority() -> Dict:
+    """Popen arguments that start ffmpeg below normal scheduling priority"""
+    if sys.platform == "win32":
+        return {"creationflags": subprocess.BELOW_NORMAL_PRIORITY_CLASS}
+    return {"preexec_fn": lambda: os.nice(config.auto_remux_nice)}
+
+
+class TranscodeQueue:
+    """Persistent queue of m3u8 export jobs run by a fixed number of workers.
+
+    ``mp4`` jobs are remuxed by ffmpeg subprocesses, ``ts`` jobs are concatenated in the ts_concat process
+    pool unless the recording has discontinuities, then ffmpeg remuxes them too. Jobs are stored in the catalog database, so queued and interrupted jobs are picked up again on
+    the next start. At most one unfinished job exists per title and format; submitting it again returns
+    that job.
+
+    Automatic jobs queued when a recording finishes have their own ``auto_remux_workers`` workers and
+    run with a lower priority and a read rate budget, so they never hold up jobs requested by users.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.auto_queue: asyncio.Queue = asyncio.Queue()
+        self.active: Dict[Tuple[str, str], TranscodeJob] = {}
+        self.history: Deque[TranscodeJob] = deque(maxlen=config.transcode_history)
+        self.events: Dict[int, asyncio.Event] = {}
+        self.workers: List[asyncio.Task] = []
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.media_seconds = 0.
+        self.busy_seconds = 0.
+
+    async def start(self):
+        jobs = await asyncio.to_thread(_load, "status IN ('queued', 'running') ORDER BY id")
+        finished = await asyncio.to_thread(_load, "status IN ('done', 'failed') ORDER BY id DESC LIMIT ?",
+                                           (config.transcode_history,))
+        self.history.extend(reversed(finished))
+        for job in jobs:
+            if job.status == "running":
+                job.status = "queued"
+                job.out_time = job.progress = 0
+                job.bytes = 0
+                await asyncio.to_thread(_save, job)
+            self._enqueue(job)
+        if jobs:
+            logger.info(f"Resumed {len(jobs)} transcode jobs")
+        self.workers = [asyncio.create_task(self._worker(self.queue), name=f"Transcode-{i}")
+                        for i in range(max(1, config.transcode_workers))]
+        self.workers += [asyncio.create_task(self._worker(self.auto_queue), name=f"Transcode-auto-{i}")
+                         for i in range(max(1, config.auto_remux_workers))]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        ts_concat.close()
+
+    def _enqueue(self, job: TranscodeJob):
+        self.active[(job.title, job.format)] = job
+        self.events[job.id] = asyncio.Event()
+        (self.auto_queue if job.auto else self.queue).put_nowait(job)
+
+    async def submit(self, file_name: str, title: str, duration: float = 0, format: str = "mp4",
+                     auto: bool = False) -> TranscodeJob:
+        if format not in ("mp4", "ts"):
+            raise ValueError(f"Unsupported format {format}")
+        job = self.active.get((title, format))
+        if job is not None:
+            return job
+        job = TranscodeJob(file_name=file_name, title=title, format=format, auto=auto, duration=duration,
+                           created=time.time())
+        await asyncio.to_thread(_save, job)
+        self._enqueue(job)
+        logger.info(f"Queued {'auto ' if auto else ''}{format} job {job.id} {title}")
+        return job
+
+    async def wait(self, job: TranscodeJob) -> TranscodeJob:
+        event = self.events.get(job.id)
+        if event is not None:
+            await event.wait()
+        return job
+
+    def get(self, job_id: int) -> Union[TranscodeJob, None]:
+        for job in list(self.active.values()) + list(self.history):
+            if job.id == job_id:
+                return job
+        return None
+
+    def get_jobs(self) -> List[TranscodeJob]:
+        return sorted(self.active.values(), key=lambda it: it.id) + list(reversed(self.history))
+
+    def get_stats(self) -> TranscodeStats:
+        running = [it for it in self.active.values() if it.status == "running"]
+        busy = self.busy_seconds + sum(time.time() - it.started for it in running)
+        media = self.media_seconds + sum(it.out_time for it in running)
+        size = self.bytes + sum(it.bytes for it in running)
+        return TranscodeStats(
+            workers=len(self.workers), queued=self.queue.qsize() + self.auto_queue.qsize(), running=len(running),
+            done=self.done, failed=self.failed, bytes=size, media_seconds=round(media, 2),
+            busy_seconds=round(busy, 2), throughput=round(size / busy, 2) if busy > 0 else 0.,
+            speed=round(media / busy, 2) if busy > 0 else 0.
+        )
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            job = await queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                job.status = "queued"
+                job.out_time = job.progress = 0
+                job.bytes = 0
+                await asyncio.shield(asyncio.to_thread(_save, job))
+                raise
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                queue.task_done()
+            job.finished = time.time()
+            job.speed = 0
+            self.busy_seconds += job.finished - job.started
+            if job.status == "failed":
+                self.failed += 1
+                logger.error(f"Transcode job {job.id} {job.title} failed: {job.error}")
+            else:
+                self.done += 1
+                self.bytes += job.bytes
+                try:
+                    await asyncio.to_thread(catalog.set_export, job.title, output_path(job.title, job.format).name,
+                                            job.bytes)
+                except sqlite3.Error as e:
+                    logger.error(f"Catalog update failed: {e}")
+                self.media_seconds += job.out_time
+                logger.info(f"Transcode job {job.id} {job.title} done in {job.finished - job.started:.1f}s")
+            await asyncio.to_thread(_save, job)
+            self.active.pop((job.title, job.format), None)
+            self.history.append(job)
+            event = self.events.pop(job.id, None)
+            if event is not None:
+                event.set()
+
+    async def _run(self, job: TranscodeJob):
+        job.status = "running"
+        job.started = time.time()
+        await asyncio.to_thread(_save, job)
+        playlist = config.save_dir / job.file_name
+        if job.format == "ts" and not await asyncio.to_thread(ts_concat.has_discontinuity, playlist):
+            await self._concat(job)
+        else:
+            await self._remux(job)
+
+    @staticmethod
+    async def _concat(job: TranscodeJob):
+        rate = config.auto_remux_io_limit if job.auto else 0
+        job.bytes = await ts_concat.export_async(config.save_dir / job.file_name, output_path(job.title, "ts"), rate)
+        job.out_time = job.duration
+        job.progress = 1.
+        job.status = "done"
+
+    async def _remux(self, job: TranscodeJob):
+        output = output_path(job.title, job.format)
+        part = output.with_name(output.name + ".part")
+        args = [config.ffmpeg_path, "-hide_banner", "-nostdin", "-nostats", "-loglevel", "error", "-y"]
+        kwargs = {}
+        if job.auto:
+            if config.auto_remux_readrate:
+                args += ["-readrate", str(config.auto_remux_readrate)]
+            kwargs = _low_priority()
+        process = await asyncio.create_subprocess_exec(
+            *args, "-i", str(config.save_dir / job.file_name), "-c", "copy", "-f", "mp4" if job.format == "mp4" else "mpegts",
+            "-progress", "pipe:1", str(part),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **kwargs
+        )
+        try:
+            _, stderr = await asyncio.gather(self._read_progress(job, process.stdout), process.stderr.read())
+            code = await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            part.unlink(missing_ok=True)
+            raise
+        if code != 0:
+            part.unlink(missing_ok=True)
+            job.status = "failed"
+            job.error = stderr.decode(errors="replace").strip()[-500:] or f"ffmpeg exited with {code}"
+            return
+        os.replace(part, output)
+        job.bytes = output.stat().st_size
+        job.progress = 1.
+        job.status = "done"
+
+    @staticmethod
+    async def _read_progress(job: TranscodeJob, stream: asyncio.StreamReader):
+        """Parse the ``key=value`` blocks ffmpeg writes with ``-progress``"""
+        async for line in stream:
+            key, _, value = line.decode(errors="replace").strip().partition("=")
+            try:
+                if key == "out_time_us":
+                    job.out_time = int(value) / 1e6
+                    if job.duration > 0:
+                        job.progress = round(min(job.out_time / job.duration, 1.), 4)
+                elif key == "total_size":
+                    job.bytes = int(value)
+                elif key == "speed" and value.endswith("x"):
+                    job.speed = float(value[:-1])
+            except ValueError:
+                pass
+
+
+jobs = TranscodeQueue()
@@ -0,0 +1,128 @@
+import os
+import mmap
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Union
+
+import config
+
+PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+
+_executor: Union[ProcessPoolExecutor, None] = None
+
+
+def read_segments(path: Path) -> List[str]:
+    """Segment file names of a playlist in order"""
+    with path.open("r", encoding="utf-8") as f:
+        lines = [it.strip() for it in f]
+    return [lines[i + 1] for i, line in enumerate(lines) if line.startswith("#EXTINF:") and i + 1 < len(lines)]
+
+
+def has_discontinuity(path: Path) -> bool:
+    with path.open("r", encoding="utf-8") as f:
+        return any(it.startswith("#EXT-X-DISCONTINUITY") for it in f)
+
+
+def concat(files: List[Path], output: Path, rate: float = 0) -> int:
+    """Concatenate MPEG-TS segments into ``output`` through memory maps, returns the bytes written.
+
+    A non-zero ``rate`` caps the copy at that many bytes per second.
+    """
+    part = output.with_name(output.name + ".part")
+    size = 0
+    start = time.monotonic()
+    try:
+        with open(part, "wb") as out:
+            for it in files:
+                with open(it, "rb") as f:
+                    length = os.fstat(f.fileno()).st_size
+                    if length == 0:
+                        continue
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        if length % PACKET_SIZE or data[0] != SYNC_BYTE:
+                            raise ValueError(f"{it.name} is not an aligned MPEG-TS stream")
+                        out.write(data)
+                size += length
+                if rate:
+                    time.sleep(max(0., size / rate - (time.monotonic() - start)))
+        os.replace(part, output)
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+    return size
+
+
+def export(playlist: Path, output: Path, rate: float = 0) -> int:
+    """Write a recording without discontinuities to one ``.ts`` file, returns its size.
+
+    Joining segments across ``#EXT-X-DISCONTINUITY`` would leave clock jumps and broken continuity
+    counters nothing marks, those playlists go through ffmpeg instead.
+    """
+    if has_discontinuity(playlist):
+        raise ValueError(f"{playlist.name} has discontinuities")
+    segments = read_segments(playlist)
+    if not segments:
+        raise ValueError(f"{playlist.name} has no segments")
+    return concat([playlist.parent / it for it in segments], output, rate)
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=max(1, config.concat_workers))
+    return _executor
+
+
+async def export_async(playlist: Path, output: Path, rate: float = 0) -> int:
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), export, playlist, output, rate)
+
+
+def close():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+if __name__ == "__main__":
+    import sys
+    import shutil
+    import subprocess
+    import tempfile
+
+    import catalog
+
+    if len(sys.argv) > 1:
+        source = Path(sys.argv[1])
+    else:
+        rows = catalog.list_all()
+        if not rows:
+            sys.exit("Usage: python ts_concat.py <playlist.m3u8>")
+        source = config.save_dir / max(rows, key=lambda it: it["bytes"])["file_name"]
+    total = sum((source.parent / it).stat().st_size for it in read_segments(source))
+    segments = len(read_segments(source))
+    print(f"{source.name}: {segments} segments, {total / 1024 / 1024:.1f} MiB, "
+          f"{total / max(segments, 1) / 1024:.0f} KiB per segment")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def bench(name: str, fn):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            print(f"{name:<12} {elapsed:7.2f}s {total / elapsed / 1024 / 1024:8.1f} MiB/s")
+
+        if has_discontinuity(source):
+            print(f"{source.name} has discontinuities, skipping mmap concat")
+        else:
+            bench("mmap concat", lambda: export(source, Path(tmp) / "concat.ts"))
+        if shutil.which(config.ffmpeg_path):
+            for fmt, suffix in (("mpegts", "ts"), ("mp4", "mp4")):
+                bench(f"ffmpeg {suffix}", lambda: subprocess.run(
+                    [config.ffmpeg_path, "-hide_banner", "-loglevel", "error", "-y", "-i", str(source),
+                     "-c", "copy", "-f", fmt, str(Path(tmp) / f"ffmpeg.{suffix}")], check=True
+                ))
+        else:
+            print(f"{config.ffmpeg_path} not found, skipping ffmpeg")
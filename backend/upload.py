@@ -0,0 +1,348 @@
+import time
+import asyncio
+import sqlite3
+from collections import deque
+from pathlib import Path
+from typing import Awaitable, Callable, Deque, Dict, List, Tuple, Union
+
+from pydantic import BaseModel
+
+import config
+import catalog
+from logger import getLogger
+
+logger = getLogger("Upload", "INFO")
+
+JOB_FIELDS = ["id", "title", "status", "bvid", "error", "attempts", "created", "started", "finished"]
+PAGE_FIELDS = ["job_id", "idx", "title", "path", "size", "status", "filename", "cid", "error"]
+
+
+def _create_tables(db: sqlite3.Connection):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS upload_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            status TEXT NOT NULL,
+            bvid TEXT NOT NULL DEFAULT '',
+            error TEXT NOT NULL DEFAULT '',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created REAL NOT NULL DEFAULT 0,
+            started REAL NOT NULL DEFAULT 0,
+            finished REAL NOT NULL DEFAULT 0
+        )
+    """)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS upload_pages (
+            job_id INTEGER NOT NULL,
+            idx INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            filename TEXT NOT NULL DEFAULT '',
+            cid INTEGER NOT NULL DEFAULT 0,
+            error TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (job_id, idx)
+        )
+    """)
+
+
+catalog.register_table(_create_tables)
+
+
+class UploadPage(BaseModel):
+    job_id: int = 0
+    idx: int
+    title: str
+    path: str
+    size: int = 0
+    uploaded: int = 0
+    status: str = "queued"
+    filename: str = ""
+    cid: int = 0
+    error: str = ""
+
+
+class UploadJob(BaseModel):
+    id: int = 0
+    title: str
+    status: str = "queued"
+    bvid: str = ""
+    error: str = ""
+    attempts: int = 0
+    created: float = 0
+    started: float = 0
+    finished: float = 0
+    pages: List[UploadPage] = []
+    size: int = 0
+    uploaded: int = 0
+    speed: float = 0
+    eta: float = 0
+
+
+def _save_job(job: UploadJob):
+    values = job.dict()
+    with catalog.transaction() as db:
+        if job.id == 0:
+            cursor = db.execute(
+                f"INSERT INTO upload_jobs ({', '.join(JOB_FIELDS[1:])}) "
+                f"VALUES ({', '.join('?' * (len(JOB_FIELDS) - 1))})",
+                [values[it] for it in JOB_FIELDS[1:]]
+            )
+            job.id = cursor.lastrowid
+            for page in job.pages:
+                page.job_id = job.id
+        else:
+            db.execute(
+                f"UPDATE upload_jobs SET {', '.join(f'{it} = ?' for it in JOB_FIELDS[1:])} WHERE id = ?",
+                [values[it] for it in JOB_FIELDS[1:]] + [job.id]
+            )
+        db.executemany(
+            f"INSERT OR REPLACE INTO upload_pages ({', '.join(PAGE_FIELDS)}) VALUES ({', '.join('?' * len(PAGE_FIELDS))})",
+            [[values[it] for it in PAGE_FIELDS] for values in (page.dict() for page in job.pages)]
+        )
+
+
+def _load(where: str, params: tuple = ()) -> List[UploadJob]:
+    with catalog.transaction() as db:
+        rows = db.execute(f"SELECT * FROM upload_jobs WHERE {where}", params).fetchall()
+        jobs = [UploadJob(**dict(it)) for it in rows]
+        for job in jobs:
+            job.pages = [UploadPage(**dict(it)) for it in db.execute(
+                "SELECT * FROM upload_pages WHERE job_id = ? ORDER BY idx", (job.id,)
+            )]
+            job.size = sum(it.size for it in job.pages)
+            job.uploaded = sum(it.size for it in job.pages if it.status == "done")
+    return jobs
+
+
+class RateLimiter:
+    """Token bucket shared by every upload, ``rate`` bytes per second; 0 disables the cap"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, size: int):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate) - size
+            self.last = now
+            if self.allowance < 0:
+                await asyncio.sleep(-self.allowance / self.rate)
+
+
+class StubUploader:
+    """Local stand-in for BilibiliUploader: reads pages in chunks without sending them anywhere.
+
+    ``fail_pages`` lists page titles whose first attempt fails halfway, to exercise retries.
+    """
+
+    def __init__(self, chunk_size: int = 4 * 1024 * 1024, fail_pages: Tuple[str, ...] = ()):
+        self.chunk_size = chunk_size
+        self.fail_pages = set(fail_pages)
+
+    async def upload_page(self, path: str, title: str, throttle: Callable[[int], Awaitable],
+                          progress: Callable[[int], None]) -> Dict:
+        size = Path(path).stat().st_size
+        with open(path, "rb") as f:
+            for offset in range(0, size, self.chunk_size):
+                chunk = await asyncio.to_thread(f.read, self.chunk_size)
+                await throttle(len(chunk))
+                if title in self.fail_pages and offset >= size // 2:
+                    self.fail_pages.discard(title)
+                    raise ConnectionError(f"Stub failure on {title}")
+                progress(len(chunk))
+        return {"filename": f"stub-{Path(path).stem}", "cid": size}
+
+    async def submit(self, title: str, pages: List[Dict]) -> Dict:
+        return {"bvid": f"BVstub{abs(hash(title)) % 10 ** 8}", "aid": 0}
+
+
+class UploadManager:
+    """Persistent upload queue.
+
+    ``factory`` builds an uploader with ``upload_page(path, title, throttle, progress)`` and
+    ``submit(title, pages)``. Pages of a job are uploaded in parallel and retried on their own; finished
+    pages are stored, so a retried or resumed job only uploads what is missing before submitting.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.active: Dict[int, UploadJob] = {}
+        self.history: Deque[UploadJob] = deque(maxlen=config.upload_history)
+        self.sent: Dict[int, int] = {}
+        self.workers: List[asyncio.Task] = []
+        self.factory: Union[Callable, None] = None
+        self.limiter = RateLimiter(config.upload_rate_limit)
+
+    async def start(self, factory: Callable):
+        self.factory = factory
+        jobs = await asyncio.to_thread(_load, "status IN ('queued', 'running') ORDER BY id")
+        finished = await asyncio.to_thread(_load, "status IN ('done', 'failed') ORDER BY id DESC LIMIT ?",
+                                           (config.upload_history,))
+        self.history.extend(reversed(finished))
+        for job in jobs:
+            self._enqueue(job)
+        if jobs:
+            logger.info(f"Resumed {len(jobs)} upload jobs")
+        self.workers = [asyncio.create_task(self._worker(), name=f"Upload-{i}")
+                        for i in range(max(1, config.upload_workers))]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def _enqueue(self, job: UploadJob):
+        job.status = "queued"
+        self.active[job.id] = job
+        self.queue.put_nowait(job)
+
+    async def submit(self, title: str, videos: List[Tuple[str, str]]) -> UploadJob:
+        """Queue an upload of ``(path, page title)`` pages"""
+        pages = []
+        for i, (path, page_title) in enumerate(videos):
+            pages.append(UploadPage(idx=i, title=page_title, path=path, size=Path(path).stat().st_size))
+        job = UploadJob(title=title, pages=pages, size=sum(it.size for it in pages), created=time.time())
+        await asyncio.to_thread(_save_job, job)
+        self._enqueue(job)
+        logger.info(f"Queued upload {job.id} {title} with {len(pages)} pages")
+        return job
+
+    async def retry(self, job_id: int) -> Union[UploadJob, None]:
+        job = next((it for it in self.history if it.id == job_id and it.status == "failed"), None)
+        if job is None:
+            return None
+        self.history.remove(job)
+        job.error = ""
+        await asyncio.to_thread(_save_job, job)
+        self._enqueue(job)
+        return job
+
+    def _update(self, job: UploadJob) -> UploadJob:
+        job.uploaded = sum(it.size if it.status == "done" else it.uploaded for it in job.pages)
+        if job.status == "running" and job.started:
+            job.speed = round(self.sent.get(job.id, 0) / max(time.time() - job.started, 1e-3), 2)
+            job.eta = round((job.size - job.uploaded) / job.speed, 1) if job.speed > 0 else 0
+        else:
+            job.speed = job.eta = 0
+        return job
+
+    def get(self, job_id: int) -> Union[UploadJob, None]:
+        for job in list(self.active.values()) + list(self.history):
+            if job.id == job_id:
+                return self._update(job)
+        return None
+
+    def get_jobs(self) -> List[UploadJob]:
+        return [self._update(it) for it in sorted(self.active.values(), key=lambda it: it.id)] + \
+            list(reversed(self.history))
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+                job.status = "done"
+                logger.info(f"Upload {job.id} {job.title} done as {job.bvid}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                logger.error(f"Upload {job.id} {job.title} failed: {e}")
+            finally:
+                self.queue.task_done()
+            job.finished = time.time()
+            self._update(job)
+            await asyncio.to_thread(_save_job, job)
+            self.active.pop(job.id, None)
+            self.sent.pop(job.id, None)
+            self.history.append(job)
+
+    async def _run(self, job: UploadJob):
+        job.status = "running"
+        job.attempts += 1
+        job.started = time.time()
+        self.sent[job.id] = 0
+        await asyncio.to_thread(_save_job, job)
+        uploader = self.factory()
+        semaphore = asyncio.Semaphore(max(1, config.upload_page_concurrency))
+        results = await asyncio.gather(*[self._upload_page(uploader, job, page, semaphore)
+                                         for page in job.pages if page.status != "done"], return_exceptions=True)
+        errors = [it for it in results if isinstance(it, BaseException)]
+        if errors:
+            raise errors[0]
+        pages = [{"title": it.title, "filename": it.filename, "cid": it.cid} for it in job.pages]
+        result = await self._retry(lambda: uploader.submit(job.title, pages), f"submit of {job.title}")
+        job.bvid = str(result.get("bvid", ""))
+
+    async def _upload_page(self, uploader, job: UploadJob, page: UploadPage, semaphore: asyncio.Semaphore):
+        def progress(size: int):
+            page.uploaded += size
+            self.sent[job.id] = self.sent.get(job.id, 0) + size
+
+        async def upload():
+            page.uploaded = 0
+            page.status = "uploading"
+            return await uploader.upload_page(page.path, page.title, self.limiter.acquire, progress)
+
+        async with semaphore:
+            try:
+                result = await self._retry(upload, f"page {page.title}")
+            except Exception as e:
+                page.status = "failed"
+                page.error = str(e)
+                raise
+            page.filename = result["filename"]
+            page.cid = result["cid"]
+            page.status = "done"
+            page.error = ""
+            await asyncio.to_thread(_save_job, job)
+
+    @staticmethod
+    async def _retry(fn: Callable[[], Awaitable], name: str):
+        for attempt in range(config.upload_retries + 1):
+            try:
+                return await fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == config.upload_retries:
+                    raise
+                delay = config.upload_retry_delay * 2 ** attempt
+                logger.warning(f"Upload of {name} failed: {e}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+
+jobs = UploadManager()
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    async def main():
+        """Upload a few generated files through StubUploader and print progress"""
+        with tempfile.TemporaryDirectory() as tmp:
+            videos = []
+            for i in range(3):
+                path = Path(tmp) / f"page{i}.mp4"
+                path.write_bytes(b"\0" * (int(sys.argv[1]) if len(sys.argv) > 1 else 32 * 1024 * 1024))
+                videos.append((str(path), f"page{i}"))
+            await jobs.start(lambda: StubUploader(fail_pages=("page1",)))
+            job = await jobs.submit("Stub upload", videos)
+            while job.status in ("queued", "running"):
+                await asyncio.sleep(0.5)
+                jobs.get(job.id)
+                print(f"{job.status} {job.uploaded}/{job.size} {job.speed / 1024 / 1024:.1f} MiB/s eta {job.eta}s")
+            print(job.status, job.bvid, job.error)
+            await jobs.close()
+
+    asyncio.run(main())
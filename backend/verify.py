@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Deque, Dict, List, Tuple, Union
+
+import numpy as np
+from pydantic import BaseModel
+
+import config
+import catalog
+from clip import segment_sequence
+from playlist import PlaylistWriter
+from ts_concat import PACKET_SIZE, SYNC_BYTE
+
+NULL_PID = 0x1FFF
+PCR_CLOCK = 27_000_000
+PCR_WRAP = (1 << 33) * 300
+
+_executor: Union[ProcessPoolExecutor, None] = None
+history: Deque["RecordingReport"] = deque(maxlen=config.verify_history)
+
+
+class SegmentReport(BaseModel):
+    file_name: str
+    size: int = 0
+    packets: int = 0
+    truncated: int = 0
+    sync_errors: int = 0
+    cc_errors: int = 0
+    pcr_errors: int = 0
+    pcr_start: float = -1
+    pcr_end: float = -1
+    error: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return not (self.truncated or self.sync_errors or self.cc_errors or self.pcr_errors or self.error)
+
+
+class RecordingReport(BaseModel):
+    file_name: str
+    segments: int = 0
+    bytes: int = 0
+    missing: int = 0
+    gaps: List[Tuple[int, int]] = []
+    pcr_jumps: int = 0
+    bad: List[SegmentReport] = []
+    elapsed: float = 0
+    created: float = 0
+
+    @property
+    def ok(self) -> bool:
+        return not (self.missing or self.pcr_jumps or self.bad)
+
+
+def read_entries(path: Path) -> List[Tuple[int, float, str]]:
+    """``(sequence, duration, file_name)`` of every segment in a playlist"""
+    with path.open("r", encoding="utf-8") as f:
+        lines = [it.strip() for it in f]
+    return [(segment_sequence(lines[i + 1]), float(line.split(":")[1].split(",")[0]), lines[i + 1])
+            for i, line in enumerate(lines) if line.startswith("#EXTINF:") and i + 1 < len(lines)]
+
+
+def _pid_changes(pids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Stable order grouping packets by PID, and a mask of packets following one of the same PID"""
+    order = np.argsort(pids, kind="stable")
+    same = np.zeros(len(order), dtype=bool)
+    same[1:] = pids[order][1:] == pids[order][:-1]
+    return order, same
+
+
+def scan_segment(path: Path) -> SegmentReport:
+    """Check the 188 byte packet structure, continuity counters and PCR order of one MPEG-TS segment"""
+    report = SegmentReport(file_name=path.name)
+    try:
+        data = np.fromfile(path, dtype=np.uint8)
+    except OSError as e:
+        report.error = str(e)
+        return report
+    report.size = len(data)
+    report.truncated = len(data) % PACKET_SIZE
+    packets = data[:len(data) - report.truncated].reshape(-1, PACKET_SIZE)
+    report.packets = len(packets)
+    if not report.packets:
+        report.error = "empty segment"
+        return report
+
+    synced = packets[:, 0] == SYNC_BYTE
+    report.sync_errors = int(np.count_nonzero(~synced))
+    packets = packets[synced]
+    pids = (packets[:, 1].astype(np.int32) & 0x1F) << 8 | packets[:, 2]
+    control = packets[:, 3] >> 4 & 0x3
+    has_adaptation = (control & 0x2).astype(bool) & (packets[:, 4] > 0)
+    discontinuity = has_adaptation & (packets[:, 5] & 0x80).astype(bool)
+
+    # continuity counters advance by one per payload packet of a PID, a single repeat is allowed
+    payload = ((control & 0x1).astype(bool)) & (pids != NULL_PID)
+    counters = (packets[payload, 3] & 0xF).astype(np.int16)
+    order, same = _pid_changes(pids[payload])
+    counters = counters[order]
+    previous = np.roll(counters, 1)
+    wrong = (counters != (previous + 1) & 0xF) & (counters != previous)
+    report.cc_errors = int(np.count_nonzero(same & wrong & ~discontinuity[payload][order]))
+
+    has_pcr = has_adaptation & (packets[:, 5] & 0x10).astype(bool)
+    if has_pcr.any():
+        fields = packets[has_pcr, 6:12].astype(np.int64)
+        base = fields[:, 0] << 25 | fields[:, 1] << 17 | fields[:, 2] << 9 | fields[:, 3] << 1 | fields[:, 4] >> 7
+        pcr = base * 300 + ((fields[:, 4] & 0x1) << 8 | fields[:, 5])
+        order, same = _pid_changes(pids[has_pcr])
+        pcr = pcr[order]
+        step = pcr - np.roll(pcr, 1)
+        wrapped = step < -PCR_WRAP // 2
+        report.pcr_errors = int(np.count_nonzero(same & (step <= 0) & ~wrapped & ~discontinuity[has_pcr][order]))
+        first = pids[has_pcr][0]
+        own = pcr[pids[has_pcr][order] == first]
+        report.pcr_start = round(float(own[0]) / PCR_CLOCK, 6)
+        report.pcr_end = round(float(own[-1]) / PCR_CLOCK, 6)
+    return report
+
+
+def find_gaps(sequences: List[int]) -> List[Tuple[int, int]]:
+    """Ranges of sequence numbers skipped between consecutive segments, in playlist order.
+
+    A step back is the CDN restarting its numbering, which the Downloader records across, so only forward
+    jumps within the same numbering count as missing.
+    """
+    if len(sequences) < 2:
+        return []
+    values = np.asarray(sequences, dtype=np.int64)
+    starts = np.flatnonzero(np.diff(values) > 1)
+    return [(int(values[i]) + 1, int(values[i + 1]) - 1) for i in starts]
+
+
+def verify(path: Path) -> RecordingReport:
+    """Scan every segment of a recording and the joins between consecutive segments"""
+    start = time.perf_counter()
+    entries = read_entries(path)
+    report = RecordingReport(file_name=path.name, segments=len(entries), created=time.time())
+    report.gaps = find_gaps([it[0] for it in entries])
+    report.missing = sum(last - first + 1 for first, last in report.gaps)
+    previous: Union[Tuple[int, float, SegmentReport], None] = None
+    for sequence, duration, file_name in entries:
+        segment = scan_segment(path.parent / file_name)
+        report.bytes += segment.size
+        if not segment.ok:
+            report.bad.append(segment)
+        if previous is not None and previous[0] + 1 == sequence and min(segment.pcr_start, previous[2].pcr_end) >= 0:
+            # the clock of the next segment starts where the last one ended, unless the 33 bit counter wrapped
+            step = segment.pcr_start - previous[2].pcr_end
+            backwards = -PCR_WRAP / PCR_CLOCK / 2 < step < 0
+            if backwards or step > previous[1] + 1:
+                report.pcr_jumps += 1
+        previous = sequence, duration, segment
+    report.elapsed = round(time.perf_counter() - start, 3)
+    return report
+
+
+def insert_segments(path: Path, fills: Dict[str, List[Tuple[int, float, str]]]):
+    """Rewrite a finished playlist with refetched ``(sequence, duration, file_name)`` entries.
+
+    ``fills`` maps the file name of a segment to the entries of the gap following it, everything else keeps
+    its playlist order.
+    """
+    merged = []
+    for entry in read_entries(path):
+        merged.append(entry)
+        merged += sorted(fills.get(entry[2], []))
+    tmp = path.with_name(path.name + ".part")
+    writer = PlaylistWriter(tmp, catalog.read_playlist(path)["title"])
+    try:
+        writer.append(merged)
+    finally:
+        writer.close()
+    os.replace(tmp, path)
+    catalog.index_file(path)
+
+
+def _lower_priority():
+    if sys.platform != "win32":
+        os.nice(config.verify_nice)
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=max(1, config.verify_workers), initializer=_lower_priority)
+    return _executor
+
+
+async def verify_async(path: Path) -> RecordingReport:
+    report = await asyncio.get_running_loop().run_in_executor(get_executor(), verify, path)
+    history.append(report)
+    return report
+
+
+def get_reports() -> List[RecordingReport]:
+    return list(reversed(history))
+
+
+def close():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check the segments of recordings for corruption and gaps")
+    parser.add_argument("files", nargs="+", help="playlists, e.g. 123_19012_3_1714034239.m3u8")
+    parser.add_argument("-v", "--verbose", action="store_true", help="list every damaged segment")
+    args = parser.parse_args()
+
+    for it in args.files:
+        path = Path(it) if Path(it).exists() else config.save_dir / it
+        res = verify(path)
+        print(f"{res.file_name}: {res.segments} segments, {res.bytes / 1024 / 1024:.1f} MiB in {res.elapsed:.2f}s, "
+              f"{res.missing} missing, {res.pcr_jumps} PCR jumps, {len(res.bad)} damaged")
+        for first, last in res.gaps:
+            print(f"  gap {first}-{last}" if last > first else f"  gap {first}")
+        if args.verbose:
+            for segment in res.bad:
+                print(f"  {segment.file_name}: {segment.error or ''}truncated={segment.truncated} "
+                      f"sync={segment.sync_errors} cc={segment.cc_errors} pcr={segment.pcr_errors}")
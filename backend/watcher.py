@@ -0,0 +1,148 @@
+import os
+import json
+import asyncio
+from pathlib import Path
+from typing import AsyncIterator, Dict, Set, Tuple, Union
+
+import config
+import catalog
+import playlist
+from logger import getLogger
+
+logger = getLogger("Watcher", "INFO")
+
+
+class ChangeFeed:
+    def __init__(self):
+        self.subscribers: Set[asyncio.Queue] = set()
+
+    def publish(self, event: str, data: Dict):
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((event, data))
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """Yield server-sent events until the client goes away"""
+        queue = asyncio.Queue(maxsize=config.feed_queue_size)
+        self.subscribers.add(queue)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=config.feed_keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally:
+            self.subscribers.discard(queue)
+
+
+feed = ChangeFeed()
+
+
+def _stat(path: Path) -> Union[Tuple[float, int], None]:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def _sync_playlist(path: Path) -> Union[Tuple[str, Dict], None]:
+    row = catalog.get(path.name)
+    stat = _stat(path)
+    if stat is None:
+        if row is None:
+            return None
+        catalog.remove(path.name)
+        return "deleted", {"file_name": path.name}
+    if row is not None and (row["mtime"], row["size"]) == stat:
+        return "grown", row
+    if path.name in playlist.open_playlists:
+        # the Downloader accounts its own appends through catalog.add_segments, indexing here would count
+        # a batch twice when it lands between the playlist write and that update
+        return ("created", {"file_name": path.name}) if row is None else ("grown", row)
+    new_row = catalog.index_file(path)
+    if new_row is None:
+        return None
+    return ("created" if row is None else "grown"), new_row
+
+
+def _sync_mp4(path: Path) -> Tuple[str, Dict]:
+    stat = _stat(path)
+    if stat is not None:
+        catalog.set_export(path.stem, path.name, stat[1])
+        return "converted", {"title": path.stem, "file_name": path.name}
+    catalog.set_export(path.stem, "", 0)
+    return "mp4_deleted", {"title": path.stem, "file_name": path.name}
+
+
+async def _handle(paths: Set[Path]):
+    for path in paths:
+        try:
+            if path.suffix == ".m3u8":
+                change = await asyncio.to_thread(_sync_playlist, path)
+            elif path.suffix == ".mp4":
+                change = await asyncio.to_thread(_sync_mp4, path)
+            else:
+                continue
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot sync {path.name}: {e}")
+            continue
+        if change is not None:
+            feed.publish(*change)
+
+
+def _snapshot() -> Dict[Path, Tuple[float, int]]:
+    res = {}
+    for directory, suffix in ((config.save_dir, ".m3u8"), (config.mp4_dir, ".mp4")):
+        for entry in os.scandir(directory):
+            if not entry.name.endswith(suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # deleted since the scan, the next snapshot reports it gone
+                continue
+            res[Path(entry.path)] = (stat.st_mtime, stat.st_size)
+    return res
+
+
+async def _poll():
+    last = await asyncio.to_thread(_snapshot)
+    while True:
+        await asyncio.sleep(config.watch_interval)
+        current = await asyncio.to_thread(_snapshot)
+        changed = {it for it in current.keys() | last.keys() if current.get(it) != last.get(it)}
+        last = current
+        await _handle(changed)
+
+
+async def _watch():
+    try:
+        from watchfiles import awatch
+    except ImportError:
+        logger.info(f"watchfiles not installed, polling every {config.watch_interval}s")
+        await _poll()
+        return
+    logger.info("Watching recording directories")
+    async for changes in awatch(config.save_dir, config.mp4_dir, recursive=False):
+        await _handle({Path(path) for _, path in changes})
+
+
+async def watch():
+    """Keep the catalog in sync with save_dir and mp4_dir and publish every change on the feed.
+
+    Nothing awaits this task while the app runs, so it restarts itself after an error instead of silently
+    leaving the catalog and the feed stale.
+    """
+    while True:
+        try:
+            await _watch()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Watcher exited: {e}, restarting")
+        await asyncio.sleep(config.watch_interval)
@@ -18,7 +18,7 @@ function ConvertButton({filename = ""}) {
                     if (data.data.code !== 0) {
                         message.error(data.data.msg);
                     } else {
-                        message.success('Convert Success');
+                        message.success('Convert queued');
                     }
                 } catch (_) {
 
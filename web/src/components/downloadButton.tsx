@@ -21,7 +21,7 @@ function DownloadButton({filename = "", title = ""}) {
                 onClick={async () => {
                     try {
                         setLoading(true);
-                        const data = await axios.get<ApiResult>(`/api/video/convert/${filename}`);
+                        const data = await axios.get<ApiResult>(`/api/video/convert/${filename}?wait=true`);
                         setLoading(false);
                         if (data.data.code !== 0) {
                             message.error(data.data.msg);
@@ -63,7 +63,7 @@ function OptionsAction({rows, reload}: {rows: VideoItem[], reload: () => void})
                             const title = await formModalRef.current?.open(`You are uploading as ${data.data.msg}`);
                             message.info('Preprocessing, please wait...')
                             await doAction(async (filename) => {
-                                const data = await axios.get<ApiResult>(`/api/video/convert/${filename}`);
+                                const data = await axios.get<ApiResult>(`/api/video/convert/${filename}?wait=true`);
                                 if (data.data.code !== 0) {
                                     message.error(data.data.msg);
                                 }
@@ -1,4 +1,4 @@
-import { useRef } from "react";
+import { useEffect, useRef, useState } from "react";
 import type { ProColumns, ActionType } from '@ant-design/pro-components';
 import { ProTable } from '@ant-design/pro-components';
 import { Space, message } from 'antd';
@@ -118,10 +118,37 @@ const columns: ProColumns<VideoItem>[] = [
 
 export default () => {
     const actionRef = useRef<ActionType>();
+    const [rows, setRows] = useState<VideoItem[]>([]);
+    useEffect(() => {
+        let timer: ReturnType<typeof setTimeout> | undefined;
+        const source = new EventSource('/api/video/events');
+        const reload = () => {
+            if (timer === undefined) {
+                timer = setTimeout(() => {
+                    timer = undefined;
+                    actionRef.current?.reload();
+                }, 2000);
+            }
+        };
+        ['created', 'converted', 'deleted', 'mp4_deleted'].forEach(event => {
+            source.addEventListener(event, reload);
+        });
+        // recordings in progress grow every few seconds, only their duration changes
+        source.addEventListener('grown', (event: MessageEvent) => {
+            const data = JSON.parse(event.data) as VideoItem;
+            setRows(prev => prev.map(row => row.file_name === data.file_name ? {...row, duration: data.duration} : row));
+        });
+        return () => {
+            clearTimeout(timer);
+            source.close();
+        };
+    }, []);
     return (
         <ProTable<VideoItem>
             actionRef={actionRef}
             columns={columns}
+            dataSource={rows}
+            onDataSourceChange={setRows}
             request={async (params, sort) => {
                 params.sort = sort;
                 let data = (await axios.post('/api/video/list', params)).data;